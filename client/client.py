@@ -1,26 +1,115 @@
 import socket
 import os
 import sys
+import json
+import mmap
+import select
+import time
+import collections
 import argparse
 from urllib.parse import urlparse
 
-# Define a constant for our buffer size
-BUFFER_SIZE = 1024
+# Define a constant for our default buffer size.  Response bodies are received
+# into a single preallocated buffer of this size that is reused for every recv,
+# so nothing is allocated per chunk.  It can be changed with --buffer-size.
+BUFFER_SIZE = 64 * 1024
+receive_buffer = bytearray(BUFFER_SIZE)
+
+# When set (with --mmap), downloads are received straight into a memory map of
+# the output file, sized from the Content-Length, instead of through the buffer.
+use_mmap = False
+
+# How long to wait on a silent connection before treating it as dropped
+SOCKET_TIMEOUT = 30
+
+# How many times to retry a download that was cut off part way through
+DEFAULT_RETRIES = 3
+
+# Partial downloads are written next to the final file, along with a sidecar
+# checkpoint recording which byte ranges have been received.  The checkpoint
+# is rewritten every CHECKPOINT_INTERVAL bytes.
+PARTIAL_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.part.json'
+CHECKPOINT_INTERVAL = 1024 * 1024
+
+# Persistent connections are kept in a pool, keyed by (host, port), so that
+# later requests to the same server skip connection setup.  Idle connections
+# are dropped after POOL_IDLE_TIMEOUT seconds, which is kept below the
+# servers' own keep-alive timeout, and at most POOL_MAX_IDLE are kept per host.
+POOL_IDLE_TIMEOUT = 10
+POOL_MAX_IDLE = 4
+connection_pool = {}
+
+# Hedged requests (--hedge).  If the first byte of a replica's response has not
+# arrived within the HEDGE_PERCENTILE of recent replica first-byte latencies,
+# the same request is also sent to another replica and whichever answers first
+# is used.  The load balancer's own quick redirects are not counted, and a
+# hedged response is timed from the request that won, not the first one sent.
+# Until HEDGE_MIN_SAMPLES latencies have been seen we wait HEDGE_DEFAULT_DELAY.
+# The other replicas come from the load balancer's X-Replicas header and from
+# --replicas.
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 5
+HEDGE_DEFAULT_DELAY = 0.5
+hedging = False
+configured_replicas = []
+first_byte_latencies = collections.deque(maxlen=100)
+
+# The timeline of the current download: when each connection was made, each
+# response started to arrive and the download finished, so that a slow
+# download can be pinned on the load balancer, the network or a replica.  It
+# is printed along with the request ID the load balancer gave the download.
+timeline = []
 
 # A function for creating HTTP GET messages.
-def prepare_get_message(host, port, file_name):
-    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
-    return request
+def prepare_get_message(host, port, file_name, extra_headers=None):
+    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n'
+    if extra_headers:
+        for name, value in extra_headers.items():
+            request = request + f'{name}: {value}\r\n'
+    return request + '\r\n'
+
+
+# Check a URL and split it into its host, port and path.
+def parse_url(url):
+    parsed_url = urlparse(url)
+    if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
+        raise ValueError
+    file_name = parsed_url.path
+    if (parsed_url.query != ''):
+        file_name = file_name + '?' + parsed_url.query
+    return parsed_url.hostname, parsed_url.port, file_name
+
+# Split a host:port string into a (host, port) pair.
+def parse_replica(replica):
+    host, _, port = replica.strip().partition(':')
+    if ((host == '') or (not port.isdigit())):
+        raise ValueError
+    return host, int(port)
+
+# Read the replicas given with --replicas, either as a comma separated list of
+# host:port pairs or as a file with one host:port per line (like the load
+# balancer's config file).
+def parse_replica_list(value):
+    if (os.path.isfile(value)):
+        with open(value, 'r') as replica_file:
+            entries = replica_file.read().split()
+    else:
+        entries = value.split(',')
+    return [parse_replica(entry) for entry in entries if entry.strip() != '']
 
 
 # Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+# We will strip out the \r and the \n in the process.  If the connection
+# closes before the end of the line we raise ConnectionError.
 def get_line_from_socket(sock):
     done = False
     line = ''
     while (not done):
         char = sock.recv(1).decode()
-        if (char == '\r'):
+        if (char == ''):
+            raise ConnectionError('Connection closed while reading the response')
+        elif (char == '\r'):
             pass
         elif (char == '\n'):
             done = True
@@ -28,183 +117,495 @@ def get_line_from_socket(sock):
             line = line + char
     return line
 
-# Read a file from the socket and print it out.  (For errors primarily.)
-def print_file_from_socket(sock, bytes_to_read):
+# Read the status line and headers of a response.  The headers are returned
+# as a dictionary keyed by lower-case header name.
+def get_response_from_socket(sock, show_headers=False):
+    response_line = get_line_from_socket(sock)
+    headers = {}
+    while (True):
+        header_line = get_line_from_socket(sock)
+        if (show_headers):
+            print(header_line)
+        if (header_line == ''):
+            break
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return response_line, headers
+
+# Receive a response body of bytes_to_read bytes, yielding it in chunks.  Each
+# chunk is a memoryview onto the shared receive buffer, so it is only valid
+# until the next one is received.
+def receive_chunks(sock, bytes_to_read):
+    view = memoryview(receive_buffer)
     bytes_read = 0
     while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
-        bytes_read += len(chunk)
-        print(chunk.decode())
+        received = sock.recv_into(view, min(len(view), bytes_to_read - bytes_read))
+        if (received == 0):
+            raise ConnectionError(f'Connection closed after {bytes_read} of {bytes_to_read} bytes')
+        bytes_read += received
+        yield view[:received]
 
-# Read a file from the socket and save it out.
-def save_file_from_socket(sock, bytes_to_read, file_name):
-    with open(file_name, 'wb') as file_to_write:
-        bytes_read = 0
-        while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
-            bytes_read += len(chunk)
-            file_to_write.write(chunk)
+# Read a file from the socket and print it out.  (For errors primarily.)  The
+# raw bytes go straight to stdout rather than being decoded chunk by chunk.
+def print_file_from_socket(sock, bytes_to_read):
+    sys.stdout.flush()
+    for chunk in receive_chunks(sock, bytes_to_read):
+        sys.stdout.buffer.write(chunk)
+    sys.stdout.buffer.write(b'\n')
+    sys.stdout.flush()
 
+# Load the checkpoint left by an earlier, interrupted download of a file.
+# Returns None if there is no checkpoint or its partial file has gone missing.
+def load_checkpoint(file_name):
+    try:
+        with open(file_name + CHECKPOINT_SUFFIX, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+    if (not os.path.isfile(file_name + PARTIAL_SUFFIX)):
+        return None
+    return checkpoint
 
-# Our main function.
-def main():
-    # Check command line arguments to retrieve a URL.
-    parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="URL to fetch with an HTTP GET request")
-    args = parser.parse_args()
+# Write a checkpoint out, replacing the old one atomically so that a crash
+# mid-write never leaves a corrupt sidecar behind.
+def save_checkpoint(file_name, checkpoint):
+    temp_name = file_name + CHECKPOINT_SUFFIX + '.tmp'
+    with open(temp_name, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_name, file_name + CHECKPOINT_SUFFIX)
+
+# Remove the partial file and checkpoint for a download.
+def discard_checkpoint(file_name):
+    for suffix in (PARTIAL_SUFFIX, CHECKPOINT_SUFFIX):
+        try:
+            os.remove(file_name + suffix)
+        except FileNotFoundError:
+            pass
+
+# Add the range [start, end) to the completed ranges in a checkpoint, merging
+# it with any ranges it touches.
+def record_range(checkpoint, start, end):
+    ranges = []
+    for range_start, range_end in sorted(checkpoint['ranges'] + [[start, end]]):
+        if (ranges and (range_start <= ranges[-1][1])):
+            ranges[-1][1] = max(ranges[-1][1], range_end)
+        else:
+            ranges.append([range_start, range_end])
+    checkpoint['ranges'] = ranges
+
+# Work out where to resume a download from: the end of the completed range
+# that starts at byte 0, capped at what actually made it into the partial file.
+def resume_offset(file_name, checkpoint):
+    offset = 0
+    for range_start, range_end in checkpoint['ranges']:
+        if (range_start > offset):
+            break
+        offset = max(offset, range_end)
+    return min(offset, os.path.getsize(file_name + PARTIAL_SUFFIX))
 
-    # Check the URL passed in and make sure it's valid.  If so, keep track of
-    # things for later.
+# Read a file from the socket and save it out.  The body is written into the
+# partial file starting at offset, and the checkpoint is kept up to date so
+# that an interrupted download can be resumed later.  Once every byte has
+# arrived the partial file is moved into place.
+def save_file_from_socket(sock, bytes_to_read, file_name, offset=0, checkpoint=None):
+    partial_name = file_name + PARTIAL_SUFFIX
+    bytes_read = 0
+    bytes_checkpointed = 0
     try:
-        parsed_url = urlparse(args.url)
-        if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
-            raise ValueError
-        host = parsed_url.hostname
-        port = parsed_url.port
-        file_name = parsed_url.path
-    except ValueError:
-        print('[ERROR]  Invalid URL.  Enter a URL of the form:  http://host:port/file')
-        sys.exit(1)
+        with open(partial_name, 'r+b' if offset else 'w+b') as file_to_write:
+
+            # Size the file up front and let the kernel copy each recv straight
+            # into its pages.  Anything received is in the page cache as soon as
+            # recv_into returns, so checkpoints need no flush.
+            if (use_mmap and (bytes_to_read > 0)):
+                file_to_write.truncate(offset + bytes_to_read)
+                with mmap.mmap(file_to_write.fileno(), offset + bytes_to_read) as mapped:
+                    with memoryview(mapped) as view:
+                        while (bytes_read < bytes_to_read):
+                            with view[offset + bytes_read:] as remaining:
+                                received = sock.recv_into(remaining)
+                            if (received == 0):
+                                raise ConnectionError(f'Connection closed after {offset + bytes_read} of {offset + bytes_to_read} bytes')
+                            bytes_read += received
+                            if ((checkpoint is not None) and (bytes_read - bytes_checkpointed >= CHECKPOINT_INTERVAL)):
+                                record_range(checkpoint, offset, offset + bytes_read)
+                                save_checkpoint(file_name, checkpoint)
+                                bytes_checkpointed = bytes_read
+
+            # Otherwise stream through the shared receive buffer into the file.
+            else:
+                file_to_write.seek(offset)
+                for chunk in receive_chunks(sock, bytes_to_read):
+                    file_to_write.write(chunk)
+                    bytes_read += len(chunk)
+                    if ((checkpoint is not None) and (bytes_read - bytes_checkpointed >= CHECKPOINT_INTERVAL)):
+                        file_to_write.flush()
+                        record_range(checkpoint, offset, offset + bytes_read)
+                        save_checkpoint(file_name, checkpoint)
+                        bytes_checkpointed = bytes_read
+    finally:
+        if ((checkpoint is not None) and (bytes_read < bytes_to_read)):
+            record_range(checkpoint, offset, offset + bytes_read)
+            save_checkpoint(file_name, checkpoint)
+    os.replace(partial_name, file_name)
+    discard_checkpoint(file_name)
+
 
-    # Now we try to make a connection to the server.
-    print('Connecting to server ...')
+# Check that an idle pooled connection is still usable.  Nothing should be
+# waiting to be read on it, so if it is readable the server has closed it (or
+# sent something we never asked for) and it must not be reused.
+def connection_is_healthy(sock):
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host, port))
-    except ConnectionRefusedError:
-        print('[ERROR]  That host or port is not accepting connections.')
-        sys.exit(1)
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return (not readable)
 
-    # The connection was successful, so we can prep and send our message.
-    print('[SECURED] Connection to server established. Sending message...\n')
-    message = prepare_get_message(host, port, file_name)
-    client_socket.send(message.encode())
-   
-    # Receive the response from the server and start taking a look at it
-    response_line = get_line_from_socket(client_socket)
-    response_list = response_line.split(' ')
-    headers_done = False
-        
-    # If an error is returned from the server, we dump everything sent and
-    # exit right away.  
-    if response_list[1] == '301':
-        print("[REDIRECT]")
-        
-        # Go through headers and find the size of the file, then save it.
-        url = ''
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            print(header_line)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-            elif (header_list[0] == 'Location:'):
-                url = header_list[1]
-        print_file_from_socket(client_socket, bytes_to_read)
+# Get a connection to a server, reusing an idle one from the pool if there is
+# a healthy one that has not expired.  Returns the socket and whether it was
+# reused.
+def get_connection(host, port):
+    idle = connection_pool.get((host, port), [])
+    while (idle):
+        sock, released = idle.pop()
+        if ((time.monotonic() - released < POOL_IDLE_TIMEOUT) and connection_is_healthy(sock)):
+            mark_timeline(f'reused connection to {host}:{port}')
+            return sock, True
+        sock.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(SOCKET_TIMEOUT)
+    try:
+        sock.connect((host, port))
+    except:
+        sock.close()
+        raise
+    mark_timeline(f'connected to {host}:{port}')
+    return sock, False
 
-        # Extract details from URL
-        parsed_url = urlparse(url)
+# Hand a connection back once we are finished with it.  It goes back in the
+# pool if the whole response was read and the server is keeping it open,
+# otherwise it is closed.
+def release_connection(host, port, sock, reusable):
+    idle = connection_pool.setdefault((host, port), [])
+    if (reusable and (len(idle) < POOL_MAX_IDLE)):
+        idle.append((sock, time.monotonic()))
+    else:
+        sock.close()
+
+# Close every idle connection in the pool.
+def close_pool():
+    for idle in connection_pool.values():
+        for sock, released in idle:
+            sock.close()
+    connection_pool.clear()
+
+# Send a GET request to a server, on a pooled connection if there is one, and
+# return the socket and whether it was reused.  If a pooled connection turns
+# out to have been closed by the server we try again on a new connection.
+def start_request(host, port, file_name, extra_headers=None):
+    message = prepare_get_message(host, port, file_name, extra_headers).encode()
+    while (True):
+        client_socket, reused = get_connection(host, port)
+        if (not reused):
+            print('[SECURED] Connection to server established. Sending message...\n')
+        else:
+            print('[REUSED] Reusing connection to server. Sending message...\n')
         try:
-            if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
-                raise ValueError
-        except ValueError:
-            print('[ERROR]  Invalid URL.  Enter a URL of the form:  http://host:port/file')
-            sys.exit(1)
-        host = parsed_url.hostname
-        port = parsed_url.port
-        file_name = parsed_url.path
-
-        # Connect to the server
-        print('[CONNECTING]')
+            client_socket.send(message)
+        except (ConnectionError, TimeoutError):
+            client_socket.close()
+            if (reused):
+                continue
+            raise
+        except:
+            client_socket.close()
+            raise
+        return client_socket, reused
+
+# Send a GET request to a server and read the status line and headers of the
+# response, returning them along with the socket.  The caller hands the socket
+# back with release_connection.  If a pooled connection turns out to have been
+# closed by the server before it answered, we retry once on a new connection.
+# Only requests to replicas count towards the first-byte latencies.
+def send_request(host, port, file_name, extra_headers=None, show_headers=False, replica=True):
+    while (True):
+        started = time.monotonic()
+        client_socket, reused = start_request(host, port, file_name, extra_headers)
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((host, port))
-        except ConnectionRefusedError:
-            print('[ERROR]  That host or port is not accepting connections.')
-            sys.exit(1)
-
-        # Send request to server
-        print('[SECURED] Connection to server established. Sending message...\n')
-        message = prepare_get_message(host, port, file_name)
-        client_socket.send(message.encode())
-    
-        # Receive the response from the server and start taking a look at it
-        response_line = get_line_from_socket(client_socket)
-        response_list = response_line.split(' ')
-        headers_done = False
-
-        # If it's OK, we retrieve and write the file out.
-        if response_list[1] == '200':
-            print('[SUCCESS]  Server is sending file.  Downloading it now.')
-
-            # If requested file begins with a / we strip it off.
-            while (file_name[0] == '/'):
-                file_name = file_name[1:]
-            file_name = file_name.rpartition('/')[2]
-
-            # Go through headers and find the size of the file, then save it.
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(client_socket)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
-            save_file_from_socket(client_socket, bytes_to_read, file_name)
-        
-        # Print out the error message
-        else:
-            print('[ERROR]  An error response was received from the server.  Details:\n')
-            print(response_line);
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(client_socket)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
-            print_file_from_socket(client_socket, bytes_to_read)
-    
-    # Use this branch for execution of a regluar server request
-    elif response_list[1] == '200':
+            response_line, headers = get_response_from_socket(client_socket, show_headers)
+        except (ConnectionError, TimeoutError):
+            client_socket.close()
+            if (reused):
+                continue
+            raise
+        except:
+            client_socket.close()
+            raise
+        if (replica):
+            first_byte_latencies.append(time.monotonic() - started)
+        mark_timeline(f'first byte from {host}:{port}')
+        return client_socket, response_line, headers
 
+# Work out how long to wait for the first byte of a response before hedging.
+def hedge_delay():
+    if (len(first_byte_latencies) < HEDGE_MIN_SAMPLES):
+        return HEDGE_DEFAULT_DELAY
+    latencies = sorted(first_byte_latencies)
+    return latencies[min(len(latencies) - 1, len(latencies) * HEDGE_PERCENTILE // 100)]
+
+# Send a GET request to a replica, and if it has not started answering within
+# hedge_delay() send the same request to the next of the other replicas too.
+# Whichever answers first wins and the other request is cancelled by closing
+# its connection.  Returns the (host, port) that answered along with its
+# socket, status line and headers.
+def send_hedged_request(primary, replicas, file_name, extra_headers=None):
+    alternates = [replica for replica in replicas if (replica != primary)]
+    if (not alternates):
+        client_socket, response_line, headers = send_request(primary[0], primary[1], file_name, extra_headers)
+        return primary, client_socket, response_line, headers
+
+    delay = hedge_delay()
+    started = time.monotonic()
+    primary_socket, reused = start_request(primary[0], primary[1], file_name, extra_headers)
+    pending = {primary_socket: (primary, reused, started)}
+    readable, _, _ = select.select([primary_socket], [], [], delay)
+
+    # The first replica is slow, so ask another one as well.
+    if (not readable):
+        alternate = alternates[0]
+        print(f'[HEDGING]  No response from {primary[0]}:{primary[1]} after {delay * 1000:.0f} ms.  Also asking {alternate[0]}:{alternate[1]}.')
+        mark_timeline(f'hedged to {alternate[0]}:{alternate[1]}')
+        try:
+            started = time.monotonic()
+            alternate_socket, alternate_reused = start_request(alternate[0], alternate[1], file_name, extra_headers)
+            pending[alternate_socket] = (alternate, alternate_reused, started)
+        except (ConnectionError, TimeoutError) as error:
+            print(f'[HEDGING]  Could not reach {alternate[0]}:{alternate[1]}: {error}')
+        readable, _, _ = select.select(list(pending), [], [], SOCKET_TIMEOUT)
+        if (not readable):
+            for client_socket in pending:
+                client_socket.close()
+            raise TimeoutError('No response from any replica')
+
+    # Cancel the request that lost the race.  Its connection has a response
+    # on the way, so it cannot go back in the pool.
+    winner = readable[0]
+    for client_socket in pending:
+        if (client_socket is not winner):
+            client_socket.close()
+    target, reused, started = pending[winner]
+    if (len(pending) > 1):
+        print(f'[HEDGING]  {target[0]}:{target[1]} answered first.')
+
+    try:
+        response_line, headers = get_response_from_socket(winner)
+    except (ConnectionError, TimeoutError):
+        winner.close()
+
+        # A pooled connection the server had already closed; just go again.
+        if (reused):
+            client_socket, response_line, headers = send_request(target[0], target[1], file_name, extra_headers)
+            return target, client_socket, response_line, headers
+        raise
+    except:
+        winner.close()
+        raise
+    first_byte_latencies.append(time.monotonic() - started)
+    mark_timeline(f'first byte from {target[0]}:{target[1]}')
+    return target, winner, response_line, headers
+
+# Note the time something happened during the current download.
+def mark_timeline(event):
+    timeline.append((event, time.monotonic()))
+
+# Print the timeline of the current download, with the time of each event since
+# the download started.
+def print_timeline(request_id):
+    print(f'[TIMELINE]  Request {request_id or "without an ID"}')
+    started = timeline[0][1]
+    for event, at in timeline[1:]:
+        print(f'{(at - started) * 1000:10.1f} ms  {event}')
+
+# Work out whether a connection can go back in the pool after a response.
+def keep_alive(headers):
+    return (headers.get('connection', '').lower() != 'close')
+
+# Work out how to resume a download from the checkpoint an earlier attempt
+# left behind.  Returns the offset to resume from, the checkpoint, and the
+# headers to send.  If-Range makes the server send the whole file instead if
+# its copy has changed since.
+def prepare_resume(local_name):
+    checkpoint = load_checkpoint(local_name)
+    if (checkpoint is None):
+        return 0, None, {}
+    offset = resume_offset(local_name, checkpoint)
+    validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+    if ((offset == 0) or (not validator)):
+        return 0, None, {}
+    return offset, checkpoint, {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+# Handle the response from a replica: save the file out if we got it (or the
+# rest of it), otherwise print the error that was sent.
+def save_response(client_socket, response_line, headers, local_name, offset, checkpoint):
+    response_list = response_line.split(' ')
+    bytes_to_read = int(headers.get('content-length', 0))
+
+    # If it's OK, we retrieve and write the file out, starting a fresh checkpoint.
+    if (response_list[1] == '200'):
         print('[SUCCESS]  Server is sending file.  Downloading it now.')
+        checkpoint = {'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'), 'length': bytes_to_read, 'ranges': []}
+        save_file_from_socket(client_socket, bytes_to_read, local_name, 0, checkpoint)
 
-        # If requested file begins with a / we strip it off.
-
-        while (file_name[0] == '/'):
-            file_name = file_name[1:]
-        file_name = file_name.rpartition('/')[2]
-
-        # Go through headers and find the size of the file, then save it.
-   
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        save_file_from_socket(client_socket, bytes_to_read, file_name)
-    
+    # The server is sending the rest of a file we already have part of.
+    elif (response_list[1] == '206'):
+        range_start = int(headers.get('content-range', 'bytes -1-').split(' ')[-1].partition('-')[0])
+        if (range_start != offset):
+            discard_checkpoint(local_name)
+            raise ConnectionError(f'Server resumed at byte {range_start} instead of {offset}')
+        print(f'[RESUMING]  Server is sending the rest of the file from byte {offset}.')
+        save_file_from_socket(client_socket, bytes_to_read, local_name, offset, checkpoint)
+
+    # Print out the error message
     else:
         print('[ERROR]  An error response was received from the server.  Details:\n')
         print(response_line)
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
         print_file_from_socket(client_socket, bytes_to_read)
 
+# Fetch a URL, following a redirect from the load balancer if we get one.  If
+# the transfer is cut off we retry, going straight back to the replica we were
+# redirected to so that the partial file can be resumed.
+def fetch(url, retries):
+    host, port, file_name = parse_url(url)
+
+    # If requested file begins with a / we strip it off.
+    local_name = file_name.partition('?')[0]
+    while (local_name[0] == '/'):
+        local_name = local_name[1:]
+    local_name = local_name.rpartition('/')[2]
+
+    location = None
+    replicas = list(configured_replicas)
+    attempt = 0
+    request_id = None
+    timeline.clear()
+    mark_timeline('started')
+    while (True):
+        try:
+            offset, checkpoint, extra_headers = prepare_resume(local_name)
+            if (request_id is not None):
+                extra_headers['X-Request-ID'] = request_id
+
+            # Now we try to make a connection to the server.
+            if (location is None):
+                print('Connecting to server ...')
+                target = (host, port)
+                try:
+                    client_socket, response_line, headers = send_request(host, port, file_name, extra_headers, show_headers=True, replica=False)
+                except ConnectionRefusedError:
+                    print('[ERROR]  That host or port is not accepting connections.')
+                    sys.exit(1)
+            # If we are hedging, whichever replica answers becomes the one a
+            # retry resumes from.
+            elif (hedging):
+                print('[CONNECTING]')
+                target, client_socket, response_line, headers = send_hedged_request((location[0], location[1]), replicas, location[2], extra_headers)
+                location = (target[0], target[1], location[2])
+            else:
+                print('[CONNECTING]')
+                target = (location[0], location[1])
+                client_socket, response_line, headers = send_request(location[0], location[1], location[2], extra_headers)
+
+            # The connection only goes back in the pool if we read the whole response.
+            reusable = False
+            request_id = request_id or headers.get('x-request-id')
+            try:
+                # The load balancer is redirecting us to a replica.
+                if ((location is None) and (response_line.split(' ')[1] == '301')):
+                    print("[REDIRECT]")
+                    mark_timeline('redirect received')
+                    print_file_from_socket(client_socket, int(headers.get('content-length', 0)))
+                    reusable = keep_alive(headers)
+                    try:
+                        location = parse_url(headers.get('location', ''))
+                        for replica in headers.get('x-replicas', '').split(','):
+                            if (replica.strip() != ''):
+                                replica = parse_replica(replica)
+                                if (replica not in replicas):
+                                    replicas.append(replica)
+                    except ValueError:
+                        print('[ERROR]  Invalid URL.  Enter a URL of the form:  http://host:port/file')
+                        sys.exit(1)
+                    continue
+
+                # Either we were redirected to the server that holds the file,
+                # and a retry resumes from the same copy, or the load balancer
+                # answered from its cache and a retry goes back through it.
+                save_response(client_socket, response_line, headers, local_name, offset, checkpoint)
+                reusable = keep_alive(headers)
+                mark_timeline('complete')
+                print_timeline(request_id)
+                return
+            finally:
+                release_connection(target[0], target[1], client_socket, reusable)
+
+        except (ConnectionError, TimeoutError) as error:
+            attempt += 1
+            mark_timeline(f'failed: {error}')
+            if (attempt > retries):
+                print_timeline(request_id)
+                print(f'[ERROR]  Download failed after {retries} retries: {error}')
+                if (os.path.isfile(local_name + CHECKPOINT_SUFFIX)):
+                    print('[ERROR]  The partial download has been kept and will be resumed next time.')
+                sys.exit(1)
+            print(f'[RETRY]  {error}.  Retrying ({attempt}/{retries}) ...')
+
+            # If the replica has gone away, go back through the load balancer.
+            if (isinstance(error, ConnectionRefusedError)):
+                location = None
+
+
+# Our main function.
+def main():
+    # Check command line arguments to retrieve a URL.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs='+', help="URLs to fetch with HTTP GET requests, one after another over pooled connections")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="times to retry an interrupted download, resuming where it left off")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE, help="size in bytes of the buffer response bodies are received into")
+    parser.add_argument("--mmap", action='store_true', help="receive downloads directly into a memory map of the output file")
+    parser.add_argument("--hedge", action='store_true', help="if a replica is slow to answer, send the request to another replica too and use whichever answers first")
+    parser.add_argument("--replicas", default='', help="replicas to hedge requests to, as host:port,host:port or a file with one host:port per line")
+    args = parser.parse_args()
+
+    # Set up how response bodies are received.
+    global receive_buffer, use_mmap
+    if (args.buffer_size <= 0):
+        print('[ERROR]  The buffer size must be a positive number of bytes.')
+        sys.exit(1)
+    receive_buffer = bytearray(args.buffer_size)
+    use_mmap = args.mmap
+
+    # Set up request hedging.
+    global hedging, configured_replicas
+    hedging = args.hedge
+    try:
+        configured_replicas = parse_replica_list(args.replicas)
+    except ValueError:
+        print('[ERROR]  Invalid replica list.  Enter replicas as host:port,host:port or a file with one host:port per line')
+        sys.exit(1)
+
+    # Check the URLs passed in and make sure they're valid.
+    try:
+        for url in args.url:
+            parse_url(url)
+    except ValueError:
+        print('[ERROR]  Invalid URL.  Enter a URL of the form:  http://host:port/file')
+        sys.exit(1)
+
+    try:
+        for url in args.url:
+            fetch(url, args.retries)
+    finally:
+        close_pool()
+
 if __name__ == '__main__':
     main()
@@ -1,24 +1,166 @@
 import socket
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import random
 import time
 import sys
 import argparse
-from signal import signal, SIGINT
+from signal import signal, SIGINT, SIGTERM, SIGUSR1, SIGUSR2
 from urllib.parse import urlparse
 import threading
+import json
+import queue
+import math
+import re
+import posixpath
+import tracemalloc
+import selectors
+import tempfile
+from collections import OrderedDict, deque
 
 BUFFER_SIZE = 1024
 TIMEOUT = 300
-# Test file that has been placed in all servers
+# How long a persistent client connection may sit idle before we close it
+KEEP_ALIVE_TIMEOUT = 15
+# Test file that has been placed in all servers, and how long to wait for a server to connect or send more of it before giving up on the server
 TEST_FILE = "test.jpg"
+TEST_TIMEOUT = 5
+# Request metrics are served in Prometheus text format at METRICS_PATH. Latencies are counted into histogram buckets with these upper bounds (in seconds)
+METRICS_PATH = '/metrics'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# Weight given to each new latency measurement in a server's moving average
+EWMA_ALPHA = 0.3
+metrics_lock = threading.Lock()
+metrics = {
+    'requests': {},
+    'latency_buckets': [0] * len(LATENCY_BUCKETS),
+    'latency_sum': 0.0,
+    'latency_count': 0,
+    'bytes_sent': 0,
+    'in_flight': 0,
+    'selections': {},
+    'latency_ewma': {},
+    'log_dropped': 0,
+    'cache': {'hit': 0, 'stale': 0, 'miss': 0, 'bypass': 0},
+}
+# Admission control. Requests are served by a pool of MAX_CONNECTIONS worker threads, and up to MAX_QUEUE more may wait for a free worker
+# Beyond that, new requests are turned away at once with a 503 and a Retry-After of RETRY_AFTER seconds rather than being left to time out
+# Connections waiting for a request do not hold a worker: they are watched by a single thread with idle_selector, and only queued for a worker once a request arrives
+# Each client address can also be given a token bucket allowing --rate-limit requests a second in bursts of up to RATE_BURST
+# This is off by default (a RATE_LIMIT of 0), as clients sharing an address, such as everyone behind one proxy, would throttle each other
+# Buckets are pruned once there are more than RATE_BUCKETS_MAX of them. LISTEN_BACKLOG is how many connections may wait to be accepted
+LISTEN_BACKLOG = 128
+MAX_CONNECTIONS = 64
+MAX_QUEUE = 128
+RETRY_AFTER = 1
+RATE_LIMIT = 0
+RATE_BURST = 100
+RATE_BUCKETS_MAX = 10000
+connection_queue = None
+rate_limit = RATE_LIMIT
+rate_burst = RATE_BURST
+rate_buckets = {}
+rate_lock = threading.Lock()
+idle_selector = selectors.DefaultSelector()
+# Draining. On SIGTERM we stop accepting connections, close the ones sitting idle, and exit once the requests in progress are done or DRAIN_TIMEOUT seconds have passed
+# The listening socket is bound once and kept across idle reboots. It may be handed to us by a service manager (LISTEN_FDS, starting at descriptor LISTEN_FDS_START,
+# as systemd does), and is otherwise bound with SO_REUSEPORT so that a new load balancer can start on the same port while the old one drains
+DRAIN_TIMEOUT = 30
+LISTEN_FDS_START = 3
+drain_timeout = DRAIN_TIMEOUT
+draining = threading.Event()
+listening_socket = None
+idle_lock = threading.Lock()
+# Edge cache. With --edge-cache, files of up to EDGE_CACHE_OBJECT_SIZE bytes are fetched from a server once and then served straight from memory with a 200,
+# saving the client a redirect and a second connection. Larger files, cache misses and range requests are still redirected
+# A miss starts a background fetch (at most EDGE_CACHE_MAX_FETCHES at a time) so that the next request for the file is a hit
+# Entries are kept in least recently used order up to EDGE_CACHE_MAX_BYTES in total. After EDGE_CACHE_TTL seconds an entry is stale: it is still served,
+# while one background fetch revalidates it with the server it came from using If-None-Match. Files too large to cache are remembered (with no body)
+# so we do not keep fetching them
+EDGE_CACHE_OBJECT_SIZE = 64 * 1024
+EDGE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+EDGE_CACHE_TTL = 30
+EDGE_CACHE_MAX_FETCHES = 16
+EDGE_CACHE_FETCH_TIMEOUT = 5
+edge_cache_enabled = False
+edge_cache_object_size = EDGE_CACHE_OBJECT_SIZE
+edge_cache_max_bytes = EDGE_CACHE_MAX_BYTES
+edge_cache_ttl = EDGE_CACHE_TTL
+edge_cache = OrderedDict()
+edge_cache_bytes = 0
+edge_cache_fetching = set()
+edge_cache_lock = threading.Lock()
+# The latency and health of each server is saved to STATE_FILE after every round of testing, as a latency in milliseconds or -1 for a server that is down
+# On start up (and after an idle reboot) we route with the saved table straight away and test the servers again in the background
+STATE_FILE = 'balancer_state.json'
+# The list of servers to pick from, weighted by latency, and the X-Replicas header sent with redirects. Replaced as a whole when the servers are retested
+routing = ([], '')
+# Profiling and tracing. Clients on this machine can send GET requests for DEBUG_PATH followed by a command: profile/start and profile/stop run a sampling profiler,
+# which looks at every thread's stack each PROFILE_INTERVAL seconds; memory takes a tracemalloc snapshot (starting tracemalloc the first time) and memory/stop stops it;
+# timings dumps the last TIMINGS_SIZE requests with how long each phase of handling them took. SIGUSR1 starts and stops the profiler and SIGUSR2 takes a memory snapshot
+# and dumps the timings, with the reports written to files named after DEBUG_REPORT_PREFIX in the system's temporary directory (or the one given with --debug-dir)
+DEBUG_PATH = '/debug/'
+DEBUG_REPORT_PREFIX = 'debug-'
+debug_report_dir = tempfile.gettempdir()
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 25
+TIMINGS_SIZE = 1000
+profile_lock = threading.Lock()
+profile = None
+memory_snapshot = None
+timings = deque(maxlen=TIMINGS_SIZE)
+request_phases = threading.local()
+# Request IDs. Each request is given an ID (or keeps the one the client sent in X-Request-ID), which we send back in the X-Request-ID header and log
+# Redirects also carry it as a request_id query parameter on the Location URL, so the server the client is sent to can log the same ID
+# Only IDs matching REQUEST_ID_PATTERN are accepted from clients, as they are copied into our response headers
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+# Access log. Each request is written as a JSON line to ACCESS_LOG_FILE by a background thread, so serving a client never waits on the disk or terminal
+# Records are handed over through a queue of up to ACCESS_LOG_QUEUE_SIZE; when it is full records are dropped (and counted) instead of holding up the request
+# Only ACCESS_LOG_SAMPLE_RATE of successful requests are logged (errors always are), and the file is rotated past ACCESS_LOG_MAX_BYTES keeping ACCESS_LOG_BACKUPS old files
+ACCESS_LOG_FILE = 'access.log'
+ACCESS_LOG_QUEUE_SIZE = 10000
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 3
+access_log_queue = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
 
 # Function to set up ctrl C signal handler for closing the server properly
 def signal_handler(sig, frame):
     print("\nInterrupt received, shutting down ...")
     sys.exit(0)
 
+# Function to handle SIGTERM, shutting down without cutting off any requests in progress
+# Connections already waiting to be accepted are taken and served, so that closing the listening socket does not reset them
+def drain_handler(sig, frame):
+    if (draining.is_set()):
+        return
+    print("\nTerminate received, draining connections ...")
+    draining.set()
+
+    # We may not be listening yet, if we are still starting up
+    if (listening_socket is not None):
+        listening_socket.setblocking(False)
+        while(1):
+            try:
+                conn, addr = listening_socket.accept()
+            except OSError:
+                break
+            conn.settimeout(KEEP_ALIVE_TIMEOUT)
+            queue_connection(conn, addr)
+        listening_socket.close()
+
+    # Close connections waiting for their next request, then wait for the rest
+    with idle_lock:
+        for key in list(idle_selector.get_map().values()):
+            idle_selector.unregister(key.fileobj)
+            key.fileobj.close()
+    deadline = time.monotonic() + drain_timeout
+    while (((metrics['in_flight'] > 0) or (connection_queue.qsize() > 0)) and (time.monotonic() < deadline)):
+        time.sleep(0.1)
+    if (metrics['in_flight'] > 0):
+        print('[ERROR] Drain timed out with', metrics['in_flight'], 'connections still open')
+    sys.exit(0)
+
 # Function that prepares a simple HTTP GET message
 def prepare_get_message(host, port, file_name):
     request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
@@ -30,7 +172,9 @@ def get_line_from_socket(sock):
     line = ''
     while (not done):
         char = sock.recv(1).decode()
-        if (char == '\r'):
+        if (char == ''):
+            raise ConnectionError('Connection closed by peer')
+        elif (char == '\r'):
             pass
         elif (char == '\n'):
             done = True
@@ -38,11 +182,24 @@ def get_line_from_socket(sock):
             line = line + char
     return line
 
+# Function for reading the headers of a request into a dictionary keyed by lower-case header name
+def get_headers_from_socket(sock):
+    headers = {}
+    while (True):
+        header_line = get_line_from_socket(sock)
+        if (header_line == ''):
+            break
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
 # Function used to retrieve an error file from an HTTP response, after the headers have been read
 def print_file_from_socket(sock, bytes_to_read):
     bytes_read = 0
     while (bytes_read < bytes_to_read):
         chunk = sock.recv(BUFFER_SIZE)
+        if (chunk == b''):
+            raise ConnectionError('Connection closed by peer')
         bytes_read += len(chunk)
         print(chunk.decode())
 
@@ -52,6 +209,8 @@ def save_file_from_socket(sock, bytes_to_read, file_name):
         bytes_read = 0
         while (bytes_read < bytes_to_read):
             chunk = sock.recv(BUFFER_SIZE)
+            if (chunk == b''):
+                raise ConnectionError('Connection closed by peer')
             bytes_read += len(chunk)
             file_to_write.write(chunk)
 
@@ -67,49 +226,352 @@ def create_balancer_list(server_dict):
         index-=1
     return balancer_list
 
+# Status lines for every response we send, and the Connection headers, are built once rather than for every response
+STATUS_LINES = {
+    '200': 'HTTP/1.1 200 OK\r\n',
+    '301': 'HTTP/1.1 301 Moved Permanently\r\n',
+    '404': 'HTTP/1.1 404 Not Found\r\n',
+    '501': 'HTTP/1.1 501 Method Not Implemented\r\n',
+    '503': 'HTTP/1.1 503 Service Unavailable\r\n',
+    '505': 'HTTP/1.1 505 Version Not Supported\r\n',
+}
+CONNECTION_HEADERS = {True: 'Connection: keep-alive\r\n', False: 'Connection: close\r\n'}
+
+# The pages sent with our responses are read into memory once, at startup
+PAGES = ('301.html', '501.html', '503.html', '505.html')
+page_cache = {}
+
+# The Date header only changes once a second, so we keep the last one we built along with the second it was built for
+date_header_cache = (0, '')
+
+# Function to read the response pages into memory
+def load_pages():
+    for page in PAGES:
+        with open(page, 'rb') as page_file:
+            page_cache[page] = page_file.read()
+
+# Function to get the Date header for a response, rebuilding it only when the second has changed since it was last built
+def get_date_header():
+    global date_header_cache
+    now = int(time.time())
+    second, header = date_header_cache
+    if (second != now):
+        header = 'Date: ' + datetime.fromtimestamp(now).strftime('%a, %d %b %Y %H:%M:%S EDT') + '\r\n'
+        date_header_cache = (now, header)
+    return header
+
 # Function create an HTTP response
 def prepare_response_message(value):
-    date = datetime.now()
-    date_string = 'Date: ' + date.strftime('%a, %d %b %Y %H:%M:%S EDT')
-    message = 'HTTP/1.1 '
-    if value == '200':
-        message = message + value + ' OK\r\n' + date_string + '\r\n'
-    elif value == '404':
-        message = message + value + ' Not Found\r\n' + date_string + '\r\n'
-    elif value == '501':
-        message = message + value + ' Method Not Implemented\r\n' + date_string + '\r\n'
-    elif value == '505':
-        message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
-    elif value == '301':
-        message = message + value + ' Moved Permanently\r\n' + date_string + '\r\n'
-    return message
-
-# A function to send the given response and file back to the client
-def send_response_to_client(sock, code, body_file, host, port, req_file):
-
-    # Response type is html here because the load balancer only sends 301, 505, and 501 responses
-    type = 'text/html'
-
-    # Get size of file
-    file_size = os.path.getsize(body_file)
-
-    # Construct header and send it
+    return STATUS_LINES[value] + get_date_header()
+
+# A function to send the given response and page back to the client. The Connection header tells the client whether we will keep the connection open
+# Redirects also carry the X-Replicas header listing every active server, so that clients can hedge a slow request by sending it to another server
+# The whole response is built with one join and sent with one sendall. Returns the number of bytes sent
+def send_response_to_client(sock, code, body_file, host, port, req_file, keep_alive=True, replicas_header='', retry_after=None, request_id=None):
+
+    # Response type is html here because the load balancer only sends 301, 501, 503 and 505 responses
+    body = page_cache[body_file]
+    parts = [prepare_response_message(code), 'Content-Type: text/html\r\nContent-Length: ', str(len(body)), '\r\n']
     if(code == '301'):
-        header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) 
-        header+= '\r\nLocation: ' + 'http://' + host + ':' + port + '/' + req_file + '\r\n\r\n'
-        sock.send(header.encode())
+        parts += ['Location: http://', host, ':', port, '/', req_file]
+        if (request_id is not None):
+            parts += ['&' if ('?' in req_file) else '?', 'request_id=', request_id]
+        parts += ['\r\n', replicas_header]
+    if (retry_after is not None):
+        parts += ['Retry-After: ', str(retry_after), '\r\n']
+    if (request_id is not None):
+        parts += ['X-Request-ID: ', request_id, '\r\n']
+    parts += [CONNECTION_HEADERS[keep_alive], '\r\n']
+    message = ''.join(parts).encode() + body
+    sock.sendall(message)
+    return len(message)
+
+# Function to send a response whose body is text we have generated rather than a file. Returns the number of bytes sent
+def send_text_to_client(sock, code, text, type, keep_alive=True, request_id=None):
+    body = text.encode()
+    parts = [prepare_response_message(code), 'Content-Type: ', type, '\r\nContent-Length: ', str(len(body)), '\r\n']
+    if (request_id is not None):
+        parts += ['X-Request-ID: ', request_id, '\r\n']
+    header = ''.join(parts + [CONNECTION_HEADERS[keep_alive], '\r\n'])
+    message = header.encode() + body
+    sock.sendall(message)
+    return len(message)
+
+# Function to send a file from the edge cache, with the validators the server gave us for it. Returns the number of bytes sent
+def send_cached_to_client(sock, entry, keep_alive=True, request_id=None):
+    parts = [prepare_response_message('200'), 'Content-Type: ', entry['type'], '\r\nContent-Length: ', str(len(entry['body'])), '\r\n',
+        'ETag: ', entry['etag'], '\r\nLast-Modified: ', entry['last_modified'], '\r\n']
+    if (request_id is not None):
+        parts += ['X-Request-ID: ', request_id, '\r\n']
+    header = ''.join(parts + [CONNECTION_HEADERS[keep_alive], '\r\n'])
+    message = header.encode() + entry['body']
+    sock.sendall(message)
+    return len(message)
+
+# Function to record a finished request in the metrics
+def record_request(code, duration, bytes_sent):
+    with metrics_lock:
+        metrics['requests'][code] = metrics['requests'].get(code, 0) + 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if (duration <= bound):
+                metrics['latency_buckets'][index] += 1
+                break
+        metrics['latency_sum'] += duration
+        metrics['latency_count'] += 1
+        metrics['bytes_sent'] += bytes_sent
+
+# Function to fold a new latency measurement for a server into its moving average
+def record_server_latency(server, latency):
+    with metrics_lock:
+        previous = metrics['latency_ewma'].get(server)
+        if (previous is None):
+            metrics['latency_ewma'][server] = latency
+        else:
+            metrics['latency_ewma'][server] = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * previous
+
+# Function to render the metrics in the Prometheus text exposition format
+def render_metrics():
+    with metrics_lock:
+        lines = ['# HELP balancer_requests_total Requests served, by response status.', '# TYPE balancer_requests_total counter']
+        for code, count in sorted(metrics['requests'].items()):
+            lines.append('balancer_requests_total{code="' + code + '"} ' + str(count))
+        lines.append('# HELP balancer_request_duration_seconds Time taken to serve a request.')
+        lines.append('# TYPE balancer_request_duration_seconds histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, metrics['latency_buckets']):
+            cumulative += count
+            lines.append('balancer_request_duration_seconds_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append('balancer_request_duration_seconds_bucket{le="+Inf"} ' + str(metrics['latency_count']))
+        lines.append('balancer_request_duration_seconds_sum ' + str(metrics['latency_sum']))
+        lines.append('balancer_request_duration_seconds_count ' + str(metrics['latency_count']))
+        lines.append('# HELP balancer_bytes_sent_total Bytes sent to clients, headers included.')
+        lines.append('# TYPE balancer_bytes_sent_total counter')
+        lines.append('balancer_bytes_sent_total ' + str(metrics['bytes_sent']))
+        lines.append('# HELP balancer_connections_in_flight Client connections with a request being served.')
+        lines.append('# TYPE balancer_connections_in_flight gauge')
+        lines.append('balancer_connections_in_flight ' + str(metrics['in_flight']))
+        lines.append('# HELP balancer_connections_idle Client connections open and waiting for a request.')
+        lines.append('# TYPE balancer_connections_idle gauge')
+        lines.append('balancer_connections_idle ' + str(len(idle_selector.get_map())))
+        lines.append('# HELP balancer_connections_queued Client connections waiting for a free worker.')
+        lines.append('# TYPE balancer_connections_queued gauge')
+        lines.append('balancer_connections_queued ' + str(connection_queue.qsize() if connection_queue else 0))
+        lines.append('# HELP balancer_replica_selections_total Clients redirected to each server.')
+        lines.append('# TYPE balancer_replica_selections_total counter')
+        for server, count in sorted(metrics['selections'].items()):
+            lines.append('balancer_replica_selections_total{replica="' + server + '"} ' + str(count))
+        lines.append('# HELP balancer_replica_latency_ewma_milliseconds Moving average of the measured latency of each server.')
+        lines.append('# TYPE balancer_replica_latency_ewma_milliseconds gauge')
+        for server, latency in sorted(metrics['latency_ewma'].items()):
+            lines.append('balancer_replica_latency_ewma_milliseconds{replica="' + server + '"} ' + str(latency))
+        lines.append('# HELP balancer_access_log_dropped_total Access log records dropped because the log queue was full.')
+        lines.append('# TYPE balancer_access_log_dropped_total counter')
+        lines.append('balancer_access_log_dropped_total ' + str(metrics['log_dropped']))
+        lines.append('# HELP balancer_edge_cache_requests_total Edge cache lookups, by result.')
+        lines.append('# TYPE balancer_edge_cache_requests_total counter')
+        for result, count in metrics['cache'].items():
+            lines.append('balancer_edge_cache_requests_total{result="' + result + '"} ' + str(count))
+        lookups = sum(metrics['cache'].values())
+        hits = metrics['cache']['hit'] + metrics['cache']['stale']
+        lines.append('# HELP balancer_edge_cache_hit_ratio Share of edge cache lookups served from the cache.')
+        lines.append('# TYPE balancer_edge_cache_hit_ratio gauge')
+        lines.append('balancer_edge_cache_hit_ratio ' + str(hits / lookups if lookups else 0.0))
+    with edge_cache_lock:
+        lines.append('# HELP balancer_edge_cache_bytes Bytes of file bodies held in the edge cache.')
+        lines.append('# TYPE balancer_edge_cache_bytes gauge')
+        lines.append('balancer_edge_cache_bytes ' + str(edge_cache_bytes))
+        lines.append('# HELP balancer_edge_cache_entries Files held in the edge cache.')
+        lines.append('# TYPE balancer_edge_cache_entries gauge')
+        lines.append('balancer_edge_cache_entries ' + str(len(edge_cache)))
+    return '\n'.join(lines) + '\n'
+
+# Function to queue a record for the access log, without ever waiting for room
+def log_access(record):
+    if ((record['status'] < '400') and (random.random() >= ACCESS_LOG_SAMPLE_RATE)):
+        return
+    entry = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds')}
+    entry.update(record)
+    try:
+        access_log_queue.put_nowait(entry)
+    except queue.Full:
+        with metrics_lock:
+            metrics['log_dropped'] += 1
+
+# Function to rotate the access log: access.log becomes access.log.1, access.log.1 becomes access.log.2 and so on, dropping the oldest
+def rotate_access_log():
+    for index in range(ACCESS_LOG_BACKUPS - 1, 0, -1):
+        if (os.path.exists(ACCESS_LOG_FILE + '.' + str(index))):
+            os.replace(ACCESS_LOG_FILE + '.' + str(index), ACCESS_LOG_FILE + '.' + str(index + 1))
+    if (ACCESS_LOG_BACKUPS > 0):
+        os.replace(ACCESS_LOG_FILE, ACCESS_LOG_FILE + '.1')
     else:
-        header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-        sock.send(header.encode())
-
-    # Open the file, read it, and send it
-    with open(body_file, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
+        os.remove(ACCESS_LOG_FILE)
+
+# Function that writes queued access log records out. It runs forever on its own thread, writing whatever has built up in the queue in one go each time round
+def access_log_writer():
+    log_file = open(ACCESS_LOG_FILE, 'a')
+    while(1):
+        lines = [json.dumps(access_log_queue.get())]
+        while(1):
+            try:
+                lines.append(json.dumps(access_log_queue.get_nowait()))
+            except queue.Empty:
                 break
+        try:
+            log_file.write('\n'.join(lines) + '\n')
+            log_file.flush()
+            if (log_file.tell() >= ACCESS_LOG_MAX_BYTES):
+                log_file.close()
+                rotate_access_log()
+                log_file = open(ACCESS_LOG_FILE, 'a')
+        except OSError as error:
+            print('[ERROR] Could not write to the access log:', error)
+
+# Function to start timing the phases of a request on this thread
+def start_phases():
+    request_phases.marks = []
+    request_phases.last = time.perf_counter()
+
+# Function to note that a phase of the current request has finished. Requests that are not being timed, such as ones turned away before they are read, are ignored
+def mark_phase(name):
+    marks = getattr(request_phases, 'marks', None)
+    if (marks is not None):
+        now = time.perf_counter()
+        marks.append((name, round((now - request_phases.last) * 1000, 3)))
+        request_phases.last = now
+
+# Function to add the phases of the current request to the timings, along with the request details in record
+def record_phases(record):
+    record['phases_ms'] = dict(request_phases.marks)
+    request_phases.marks = None
+    timings.append(record)
+
+# Function that looks at the stack of every thread but our own, counting the line each one is on and every function on its stack
+# Threads waiting inside the threading module, such as workers with no connection to serve, are left out. Runs on its own thread until stopped
+def profile_sampler(state):
+    me = threading.get_ident()
+    while (not state['stop'].wait(PROFILE_INTERVAL)):
+        frames = sys._current_frames()
+        with profile_lock:
+            for ident, frame in frames.items():
+                code = frame.f_code
+                if ((ident == me) or (code.co_filename == threading.__file__)):
+                    continue
+                key = code.co_filename + ':' + str(frame.f_lineno) + ' ' + code.co_name
+                state['self'][key] = state['self'].get(key, 0) + 1
+                seen = set()
+                while (frame is not None):
+                    code = frame.f_code
+                    key = code.co_filename + ':' + str(code.co_firstlineno) + ' ' + code.co_name
+                    if (key not in seen):
+                        seen.add(key)
+                        state['total'][key] = state['total'].get(key, 0) + 1
+                    frame = frame.f_back
+            state['samples'] += 1
+
+# Function to start the sampling profiler, unless it is already running
+def start_profiler():
+    global profile
+    with profile_lock:
+        if (profile is not None):
+            return 'The profiler is already running\n'
+        profile = {'stop': threading.Event(), 'started': time.monotonic(), 'samples': 0, 'self': {}, 'total': {}}
+        threading.Thread(target=profile_sampler, args=(profile,), daemon=True).start()
+    return 'Profiler started, sampling every ' + str(PROFILE_INTERVAL) + ' seconds\n'
+
+# Function to stop the sampling profiler and report the lines threads were most often on, and the functions most often on their stacks
+# Threads waiting for the network show up in recv, accept and the like
+def stop_profiler():
+    global profile
+    with profile_lock:
+        state = profile
+        profile = None
+    if (state is None):
+        return 'The profiler is not running\n'
+    state['stop'].set()
+    lines = ['Sampled ' + str(state['samples']) + ' times over ' + str(round(time.monotonic() - state['started'], 3)) + ' seconds', '', 'Self (the line each thread was on):']
+    for key, count in sorted(state['self'].items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+        lines.append('%8d  %s' % (count, key))
+    lines += ['', 'Total (functions on each thread\'s stack):']
+    for key, count in sorted(state['total'].items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+        lines.append('%8d  %s' % (count, key))
+    return '\n'.join(lines) + '\n'
+
+# Function to take a tracemalloc snapshot and report where memory is allocated, and what has changed since the last snapshot. The first call only starts tracing
+def snapshot_memory():
+    global memory_snapshot
+    if (not tracemalloc.is_tracing()):
+        tracemalloc.start()
+        memory_snapshot = None
+        return 'tracemalloc started, ask again for a snapshot\n'
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['Traced memory: ' + str(current) + ' bytes, peak ' + str(peak) + ' bytes', '', 'Largest allocations:']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_TOP]]
+    if (memory_snapshot is not None):
+        lines += ['', 'Changes since the last snapshot:']
+        lines += [str(stat) for stat in snapshot.compare_to(memory_snapshot, 'lineno')[:PROFILE_TOP]]
+    memory_snapshot = snapshot
+    return '\n'.join(lines) + '\n'
+
+# Function to stop tracemalloc, freeing the memory it uses
+def stop_memory_tracing():
+    global memory_snapshot
+    memory_snapshot = None
+    if (not tracemalloc.is_tracing()):
+        return 'tracemalloc is not running\n'
+    tracemalloc.stop()
+    return 'tracemalloc stopped\n'
+
+# Function to report the timings of recent requests, one JSON line each, oldest first
+def dump_timings():
+    return ''.join(json.dumps(record) + '\n' for record in list(timings))
+
+# Function to run a debug command, returning the response code and the report
+def run_debug_command(command):
+    commands = {
+        'profile/start': start_profiler,
+        'profile/stop': stop_profiler,
+        'memory': snapshot_memory,
+        'memory/stop': stop_memory_tracing,
+        'timings': dump_timings,
+    }
+    if (command not in commands):
+        return '404', 'Unknown debug command, try one of: ' + ', '.join(commands) + '\n'
+    return '200', commands[command]()
+
+# Function to write a debug report to a file and say where it went
+def write_debug_report(name, report):
+    file_name = os.path.join(debug_report_dir, DEBUG_REPORT_PREFIX + name + '-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.txt')
+    try:
+        with open(file_name, 'w') as report_file:
+            report_file.write(report)
+        print('[DEBUG] Wrote ' + file_name)
+    except OSError as error:
+        print('[ERROR] Could not write ' + file_name + ':', error)
+
+# Function to handle SIGUSR1, starting the profiler or stopping it and writing out its report
+def profile_handler(sig, frame):
+    if (profile is None):
+        print('[DEBUG] ' + start_profiler(), end='')
+    else:
+        write_debug_report('profile', stop_profiler())
+
+# Function to handle SIGUSR2, writing out a memory snapshot and the timings
+def snapshot_handler(sig, frame):
+    write_debug_report('memory', snapshot_memory())
+    write_debug_report('timings', dump_timings())
+
+# Function to pick the request ID to use: the first of the candidates that looks like one of ours, otherwise a new one
+def get_request_id(*candidates):
+    for candidate in candidates:
+        if ((candidate is not None) and REQUEST_ID_PATTERN.fullmatch(candidate)):
+            return candidate
+    return os.urandom(8).hex()
+
+# Function to check whether a client address is on this machine
+def is_local(addr):
+    return (addr[0].startswith('127.') or (addr[0] == '::1'))
 
 # Function to parse the config file, making sure that it is not full of white space
 def parse_config_file(file_name):
@@ -151,6 +613,8 @@ def parse_config_file(file_name):
                             raise ValueError
                         else:
                             pass
+                    # Make sure the port is a number
+                    int(server.partition(':')[2])
                     server_dict[server] = 0
                 else:
                     server = i
@@ -160,6 +624,8 @@ def parse_config_file(file_name):
                             raise ValueError
                         else:
                             pass
+                    # Make sure the port is a number
+                    int(server.partition(':')[2])
                     server_dict[server] = 0
                 
                     
@@ -167,64 +633,51 @@ def parse_config_file(file_name):
     return server_dict
 
 # Function for testing the latency of each server upon loading the load-balancer
+# A server that cannot be reached, does not answer within TEST_TIMEOUT, or answers with an error is marked inactive (-1), and the others are still tested
 def test_connection(server_dict): 
     epoch = datetime.utcfromtimestamp(0)
     for i in server_dict:
         server_details = i.partition(':')
         host = server_details[0]
-        try:
-            port = int(server_details[2])
-        except ValueError:
-            print("[ERROR] Incorrect config file. Enter one host:port combination per line")
-            sys.exit(1)
+        port = int(server_details[2])
         test_request = prepare_get_message(host, port, TEST_FILE)
         print(f'\n[CONNECTING] testing server {host}:{port}')
         start = datetime.now()
         try:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((host, port))
-        except ConnectionRefusedError:
-            print('[ERROR] That host or port is not accepting connections. Server is being removed from list of active servers.')
+            server_socket = socket.create_connection((host, port), TEST_TIMEOUT)
+        except OSError as error:
+            print('[ERROR] That host or port is not accepting connections (' + str(error) + '). Server is being removed from list of active servers.')
             server_dict[i] = -1
             continue
 
-        server_socket.send(test_request.encode())
-
-        response_line = get_line_from_socket(server_socket)
-        response_list = response_line.split(' ')
-        headers_done = False
-
-        # Check if there was an error. Because ever server instance should have the testing file, we will exit if there is an error
-        # So that we can place the test file in the server folders before running again
-        if response_list[1] != '200':
-            print('[ERROR]  An error response was received from the server.  Details:\n')
-            print(response_line);
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(server_socket)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
-            print_file_from_socket(server_socket, bytes_to_read)
-            sys.exit(1)
-        # If it's OK, we retrieve and write the file out.
-        else:
+        try:
+            server_socket.sendall(test_request.encode())
 
-            print('[SECURED]  Server is sending file.  Downloading it now.')
+            response_line = get_line_from_socket(server_socket)
+            response_list = response_line.split(' ')
+            headers = get_headers_from_socket(server_socket)
+            bytes_to_read = int(headers.get('content-length', 0))
 
-            # Go through headers and find the size of the file, then save it.
-    
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(server_socket)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
+            # Check if there was an error. Every server instance should have the testing file, so a server that cannot send it
+            # (or is too busy to) is left out until the servers are next tested
+            if (len(response_list) < 2) or (response_list[1] != '200'):
+                print('[ERROR]  An error response was received from the server. Server is being removed from list of active servers. Details:\n')
+                print(response_line);
+                print_file_from_socket(server_socket, bytes_to_read)
+                server_dict[i] = -1
+                continue
+
+            # If it's OK, we retrieve and write the file out.
+            print('[SECURED]  Server is sending file.  Downloading it now.')
             save_file_from_socket(server_socket, bytes_to_read, TEST_FILE)
+        except (OSError, ValueError) as error:
+            print('[ERROR] Testing the server failed (' + repr(error) + '). Server is being removed from list of active servers.')
+            server_dict[i] = -1
+            continue
+
+        # Servers keep connections open for reuse, so close ours now that the test is done
+        finally:
+            server_socket.close()
         
         # End timer and add time delay to dictionary
         finish = datetime.now()
@@ -232,45 +685,196 @@ def test_connection(server_dict):
         finish_since_epoch = (finish - epoch).total_seconds()*1000.0
         time_delay = finish_since_epoch - start_since_epoch
         server_dict[i] = time_delay
+        record_server_latency(i, time_delay)
 
         print(f"[COMPLETE] {host}:{port} start: {start} end: {finish}")
 
     return server_dict
 
 
-def handle_client():
-    # Make sure the user is passing a config file
+# Function to get a file from a server for the edge cache, sending If-None-Match when we have an ETag to revalidate
+# The Via header tells the server the request is on behalf of someone else, so it is not trusted as coming from this machine
+# Returns the response code, the headers, and the body if it was a 200 small enough to cache (otherwise None)
+def fetch_from_server(server, req_file, etag=None):
+    host, _, port = server.partition(':')
+    request = 'GET /' + req_file + ' HTTP/1.1\r\nHost: ' + server + '\r\nVia: 1.1 load-balancer\r\nConnection: close\r\n'
+    if (etag is not None):
+        request += 'If-None-Match: ' + etag + '\r\n'
+    server_socket = socket.create_connection((host, int(port)), EDGE_CACHE_FETCH_TIMEOUT)
     try:
-        args = len(sys.argv)
-        if((args == 2)):
-            pass
-        else:
-            raise ValueError
-    except ValueError:
-        print('[ERROR]  You must enter exactly 2 arguments. Usage should be: loadbalancer.py config.txt')
-        sys.exit(1)
+        server_socket.sendall((request + '\r\n').encode())
+        code = get_line_from_socket(server_socket).split(' ')[1]
+        headers = get_headers_from_socket(server_socket)
+        body = None
+        bytes_to_read = int(headers.get('content-length', 0))
+        if ((code == '200') and (bytes_to_read <= edge_cache_object_size) and ('etag' in headers)):
+            body = bytearray()
+            while (len(body) < bytes_to_read):
+                chunk = server_socket.recv(bytes_to_read - len(body))
+                if (chunk == b''):
+                    raise ConnectionError('Connection closed by peer')
+                body += chunk
+            body = bytes(body)
+    finally:
+        server_socket.close()
+    return code, headers, body
 
-    # Make sure the config file passed is in the proper format
+# Function to add an entry to the edge cache, evicting the least recently used entries until the cache is back under its size limit
+def store_in_edge_cache(req_file, entry):
+    global edge_cache_bytes
+    with edge_cache_lock:
+        old_entry = edge_cache.pop(req_file, None)
+        if (old_entry is not None):
+            edge_cache_bytes -= old_entry['size']
+        edge_cache[req_file] = entry
+        edge_cache_bytes += entry['size']
+        while (edge_cache_bytes > edge_cache_max_bytes):
+            evicted_file, evicted = edge_cache.popitem(last=False)
+            edge_cache_bytes -= evicted['size']
+
+# Function to drop an entry from the edge cache
+def forget_in_edge_cache(req_file):
+    global edge_cache_bytes
+    with edge_cache_lock:
+        entry = edge_cache.pop(req_file, None)
+        if (entry is not None):
+            edge_cache_bytes -= entry['size']
+
+# Function to make an edge cache entry from a server's 200 response. Files too large to cache are kept as entries with no body,
+# so that we know not to fetch them again until the entry is stale. Entries are charged for their key as well as their body
+def make_edge_cache_entry(server, req_file, headers, body):
+    return {
+        'server': server,
+        'body': body,
+        'type': headers.get('content-type', 'application/octet-stream'),
+        'etag': headers.get('etag', ''),
+        'last_modified': headers.get('last-modified', ''),
+        'fetched': time.monotonic(),
+        'size': len(req_file) + (len(body) if (body is not None) else 0),
+    }
+
+# Function run on its own thread to fetch a file from a server and cache it, after a miss or once its entry is stale
+# A stale copy is revalidated with If-None-Match and kept if the server says it has not changed
+# Any response other than a 200 or a 304 (a 404, or a 503 from a busy server) drops the entry, so the next request is redirected and tries again
+def fill_edge_cache(server, req_file, stale_entry=None):
     try:
-        config_file = sys.argv[1]
-        config_file_type = config_file.rpartition('.')[2]
+        code, headers, body = fetch_from_server(server, req_file, stale_entry['etag'] if (stale_entry is not None) else None)
+        if ((code == '304') and (stale_entry is not None)):
+            store_in_edge_cache(req_file, dict(stale_entry, fetched=time.monotonic()))
+        elif (code == '200'):
+            store_in_edge_cache(req_file, make_edge_cache_entry(server, req_file, headers, body))
+        else:
+            forget_in_edge_cache(req_file)
+    except (OSError, ValueError, IndexError) as error:
+        print('[ERROR] Could not fetch', req_file, 'from', server, 'for the edge cache:', repr(error))
+        forget_in_edge_cache(req_file)
+    finally:
+        with edge_cache_lock:
+            edge_cache_fetching.discard(req_file)
 
-        # Make sure config file is a .txt
+# Function to look a file up in the edge cache. Returns the entry to serve, or None if the client should be redirected
+# A miss starts a background fetch from a server in balancer_list. A stale entry is still served while it is revalidated in the background
+# with the server it came from, and a stale entry for a file we could not cache is fetched again. Only one fetch of a file runs at a time
+def lookup_edge_cache(req_file, balancer_list):
+    now = time.monotonic()
+    with edge_cache_lock:
+        entry = edge_cache.get(req_file)
+        if (entry is not None):
+            edge_cache.move_to_end(req_file)
+        stale = ((entry is not None) and (now - entry['fetched'] >= edge_cache_ttl))
+        if (((entry is None) or stale) and (req_file not in edge_cache_fetching) and (len(edge_cache_fetching) < EDGE_CACHE_MAX_FETCHES)):
+            edge_cache_fetching.add(req_file)
+            if ((entry is None) or (entry['body'] is None)):
+                fetch_args = (random.choice(balancer_list), req_file)
+            else:
+                fetch_args = (entry['server'], req_file, entry)
+            threading.Thread(target=fill_edge_cache, args=fetch_args, daemon=True).start()
 
-        if(config_file_type != 'txt'):
-            raise ValueError
+    if (entry is None):
+        result = 'miss'
+    elif (entry['body'] is None):
+        result = 'bypass'
+    elif (stale):
+        result = 'stale'
+    else:
+        result = 'hit'
+    with metrics_lock:
+        metrics['cache'][result] += 1
+    return entry if (result in ('hit', 'stale')) else None
+
+# Function to take a token from a client's bucket. Returns 0 if the request may go ahead, otherwise the number of seconds until the client will have a token again
+def take_token(client):
+    if (rate_limit <= 0):
+        return 0
+    now = time.monotonic()
+    with rate_lock:
+        tokens, updated = rate_buckets.get(client, (rate_burst, now))
+        tokens = min(rate_burst, tokens + (now - updated) * rate_limit)
+        if (tokens >= 1):
+            rate_buckets[client] = (tokens - 1, now)
+            retry_after = 0
         else:
-            # Parse config file, and store the server details in a dictionary
-            server_dict = parse_config_file(config_file)
-    except ValueError:
-        print('[ERROR]  Invalid config file. Config file must be a txt and must only contain lines of the format host:port. Only one host:port combination per line. Remove any random trailing whitespace')
-        sys.exit(1)
+            rate_buckets[client] = (tokens, now)
+            retry_after = math.ceil((1 - tokens) / rate_limit)
 
-    # Get performance of all servers
-    server_dict = test_connection(server_dict)
-    server_dict = dict(sorted(server_dict.items(), key=lambda item: item[1]))
+        # Forget clients whose buckets have filled back up, as they would start from a full bucket anyway
+        if (len(rate_buckets) > RATE_BUCKETS_MAX):
+            full_after = rate_burst / rate_limit
+            for key in [key for key, (tokens, updated) in rate_buckets.items() if (now - updated >= full_after)]:
+                del rate_buckets[key]
+    return retry_after
 
-    # Remove any inactive servers, marked by a -1 in the dictionary
+# Function to turn a connection away because we are too busy, with a 503 telling the client when to try again
+# This runs on the thread watching idle connections, so it never waits long: the response is small enough to go straight into the socket's send buffer
+def reject_connection(conn, addr, retry_after):
+    bytes_sent = 0
+    try:
+        conn.settimeout(1)
+        bytes_sent = send_response_to_client(conn, '503', '503.html', '', '', '', False, retry_after=retry_after)
+
+        # Read whatever part of the request has arrived, so that closing the socket does not reset the connection before the client reads the 503
+        conn.setblocking(False)
+        conn.recv(64 * 1024)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+    record_request('503', 0.0, bytes_sent)
+    log_access({
+        'request_id': None,
+        'client': addr[0] + ':' + str(addr[1]),
+        'method': '',
+        'path': '',
+        'status': '503',
+        'bytes': bytes_sent,
+        'duration_ms': 0.0,
+        'replica': None,
+    })
+
+# Function to load the saved latency table. Returns an empty table if there is no usable state file
+def load_state():
+    try:
+        with open(STATE_FILE, 'r') as state_file:
+            servers = json.load(state_file)['servers']
+        return {server: float(latency) for server, latency in servers.items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return {}
+
+# Function to save the latency table. It is written to a temporary file first, so a crash part way through never leaves a broken state file
+def save_state(server_dict):
+    state = {'saved': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'servers': server_dict}
+    try:
+        with open(STATE_FILE + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(STATE_FILE + '.tmp', STATE_FILE)
+    except OSError as error:
+        print('[ERROR] Could not save the server state:', error)
+
+# Function to build the routing from a latency table, leaving out inactive servers (marked by -1)
+# Returns False, leaving the routing as it was, if no servers are active
+def update_routing(server_dict):
+    global routing
+    server_dict = dict(sorted(server_dict.items(), key=lambda item: item[1]))
     for key in list(server_dict):
         if server_dict[key] == -1:
             del server_dict[key]
@@ -278,72 +882,299 @@ def handle_client():
     # Create a list of server details, where there are as many server instances as the index of the server in the sorted dictionary
     balancer_list = create_balancer_list(server_dict)
     if len(balancer_list) < 1:
-        print("[ERROR] No servers are active. Please check that servers are corrctly entered in config file. Exiting program.")
-        sys.exit(1)
-    
-    # Now that we have prioritized the servers, we can accept requests
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.bind(('', 0))
-    print('\n[ACTIVATED] Clients can create connections at port ' + str(client_socket.getsockname()[1]))
-    client_socket.listen(1)
-    client_socket.settimeout(TIMEOUT)
-    while(1):
-        print("[WAITING] Ready to receive connection from client")
-        conn, addr = client_socket.accept()
-        client_socket.settimeout(TIMEOUT)
-        print('\n[ACCEPTED CONN] connection from client address:', addr)
-        print('[SECURED] Connection to client established, waiting to receive message...')
+        return False
 
+    # Build the X-Replicas header sent with redirects once, listing each active server once
+    replicas_header = 'X-Replicas: ' + ','.join(dict.fromkeys(balancer_list)) + '\r\n'
+    routing = (balancer_list, replicas_header)
+    return True
+
+# Function run on its own thread to test the servers again while we serve clients with the saved routing
+def refresh_routing(servers):
+    try:
+        server_dict = test_connection(dict.fromkeys(servers, 0))
+    except (OSError, ValueError, IndexError) as error:
+        print('[ERROR] Could not retest the servers:', repr(error))
+        return
+    save_state(server_dict)
+    if (update_routing(server_dict)):
+        print('[REFRESHED] Server latencies have been measured again')
+    else:
+        print('[ERROR] No servers are active. Keeping the saved routing.')
+
+# Function that serves the next request on a client connection, which has been handed to us because part of it has arrived
+# Returns True if the connection should be kept open for another request
+def serve_client(conn, addr):
+    with metrics_lock:
+        metrics['in_flight'] += 1
+    try:
         # We obtain our request from the socket.  We look at the request and
         # figure out what to do based on the contents of things.
-        request = get_line_from_socket(conn)
-        print('[RECEIVED] Request:  \n' + request + '\n')
-        request_list = request.split()
+        try:
+            request = get_line_from_socket(conn)
+            request_list = request.split()
 
-        # This server doesn't care about headers, so we just clean them up.
-        while (get_line_from_socket(conn) != ''):
-            pass
+            # The only header this server cares about is whether to keep the connection open. Timing starts once the request has begun to arrive
+            start_phases()
+            headers = get_headers_from_socket(conn)
+            mark_phase('read')
+        except (ConnectionError, TimeoutError):
+            return False
+        started = time.monotonic()
+        balancer_list, replicas_header = routing
+        request_id = get_request_id(headers.get('x-request-id'))
+
+        # Once we are draining, every response closes its connection
+        keep_alive = ((headers.get('connection', '').lower() != 'close') and (not draining.is_set()))
+        replica = None
+        retry_after = take_token(addr[0])
+
+        # Clients over their request rate are told when to come back
+        if (retry_after > 0):
+            keep_alive = False
+            code = '503'
+            bytes_sent = send_response_to_client(conn, '503', '503.html', '', '', '', False, retry_after=retry_after, request_id=request_id)
 
         # Make sure it is a GET request
-        if request_list[0] != 'GET':
-                print('\n[INVALID REQUEST] Responding with error!')
-                send_response_to_client(conn, '501', '501.html', '', '', '')
+        elif request_list[0] != 'GET':
+                code = '501'
+                bytes_sent = send_response_to_client(conn, '501', '501.html', '', '', '', keep_alive, request_id=request_id)
 
         # If we did not get the proper HTTP version respond with a 505.
         elif request_list[2] != 'HTTP/1.1':
-            print('\n[INVALID HTTP] Responding with error!')
-            send_response_to_client(conn, '505', '505.html', '', '', '')
+            code = '505'
+            bytes_sent = send_response_to_client(conn, '505', '505.html', '', '', '', keep_alive, request_id=request_id)
+
+        # Report our metrics if that is what was asked for
+        elif request_list[1] == METRICS_PATH:
+            code = '200'
+            bytes_sent = send_text_to_client(conn, '200', render_metrics(), 'text/plain; version=0.0.4', keep_alive, request_id)
+
+        # Debug commands are only taken from clients on this machine
+        elif request_list[1].startswith(DEBUG_PATH) and is_local(addr):
+            code, report = run_debug_command(request_list[1][len(DEBUG_PATH):])
+            bytes_sent = send_text_to_client(conn, code, report, 'text/plain', keep_alive, request_id)
         
-        # Respond with a 301 and redirect client to source server
+        # Respond with a 301 and redirect client to source server, unless the file is in the edge cache
         else:
-            print('[SENDING] Request okay. Sending 301 permanently moved.')
 
             # Properly format requested file
             req_file = request_list[1]
             while (req_file[0] == '/'):
                 req_file = req_file[1:]
-            
+
+            # Small files we have cached are sent straight back. Range requests always go to a server, and so do debug commands and metrics:
+            # fetching them for the cache would run them on a server for clients that may not be allowed to
+            cached = None
+            path = posixpath.normpath('/' + req_file.partition('?')[0])
+            if (edge_cache_enabled and ('range' not in headers) and (path != METRICS_PATH) and (not (path + '/').startswith(DEBUG_PATH))):
+                cached = lookup_edge_cache(req_file.partition('?')[0], balancer_list)
+            if (cached is not None):
+                mark_phase('select')
+                code = '200'
+                bytes_sent = send_cached_to_client(conn, cached, keep_alive, request_id)
+
             # Get host and port details for a randomly selected server
-            balancer_len = len(balancer_list)
-            server = random.randint(0, balancer_len-1)
-            host = balancer_list[server].partition(':')[0]
-            port = balancer_list[server].partition(':')[2]
-            send_response_to_client(conn, '301', '301.html', host, port, req_file)
-        
-        # Close connection
-        conn.close()
+            else:
+                balancer_len = len(balancer_list)
+                server = random.randint(0, balancer_len-1)
+                host = balancer_list[server].partition(':')[0]
+                port = balancer_list[server].partition(':')[2]
+                mark_phase('select')
+                code = '301'
+                bytes_sent = send_response_to_client(conn, '301', '301.html', host, port, req_file, keep_alive, replicas_header, request_id=request_id)
+                replica = balancer_list[server]
+                with metrics_lock:
+                    metrics['selections'][replica] = metrics['selections'].get(replica, 0) + 1
+
+        mark_phase('send')
+        duration = time.monotonic() - started
+        record_phases({
+            'request_id': request_id,
+            'path': request_list[1] if (len(request_list) > 1) else '',
+            'status': code,
+            'bytes': bytes_sent,
+            'replica': replica,
+        })
+        record_request(code, duration, bytes_sent)
+        log_access({
+            'request_id': request_id,
+            'client': addr[0] + ':' + str(addr[1]),
+            'method': request_list[0] if (len(request_list) > 0) else '',
+            'path': request_list[1] if (len(request_list) > 1) else '',
+            'status': code,
+            'bytes': bytes_sent,
+            'duration_ms': round(duration * 1000, 3),
+            'replica': replica,
+        })
+        return keep_alive
+
+    # Done with this request
+    finally:
+        with metrics_lock:
+            metrics['in_flight'] -= 1
+
+# Function that serves requests from the queue, forever. Each worker thread handles one request at a time,
+# and hands connections the client is keeping open back to be watched until the next request arrives
+def connection_worker():
+    while(1):
+        conn, addr = connection_queue.get()
+        keep_alive = False
+        try:
+            keep_alive = serve_client(conn, addr)
+        except Exception as error:
+            print('[ERROR] Error serving client address', addr, ':', repr(error))
+        if (keep_alive):
+            watch_connection(conn, addr)
+        else:
+            conn.close()
+
+# Function to queue a connection for a worker, now that a request has arrived on it. If the queue is full we are overloaded, so the connection is turned away
+def queue_connection(conn, addr):
+    try:
+        connection_queue.put_nowait((conn, addr))
+    except queue.Full:
+        reject_connection(conn, addr, RETRY_AFTER)
+
+# Function to watch a connection until a request arrives on it. Once we are draining, connections are closed instead
+def watch_connection(conn, addr):
+    with idle_lock:
+        if (not draining.is_set()):
+            idle_selector.register(conn, selectors.EVENT_READ, (addr, time.monotonic()))
+            return
+    conn.close()
+
+# Function run on its own thread, forever, to queue connections for a worker as requests arrive on them and close those left idle for longer than KEEP_ALIVE_TIMEOUT
+def idle_watcher():
+    while(1):
+        events = idle_selector.select(1)
+        now = time.monotonic()
+        ready = []
+        expired = []
+        with idle_lock:
+
+            # Connections may have been closed by draining since the select
+            for key, mask in events:
+                if (idle_selector.get_map().get(key.fd) is key):
+                    idle_selector.unregister(key.fileobj)
+                    ready.append((key.fileobj, key.data[0]))
+            for key in list(idle_selector.get_map().values()):
+                if (now - key.data[1] >= KEEP_ALIVE_TIMEOUT):
+                    idle_selector.unregister(key.fileobj)
+                    expired.append(key.fileobj)
+        for conn, addr in ready:
+            queue_connection(conn, addr)
+        for conn in expired:
+            conn.close()
+
+# Function to get the socket to listen on. If a service manager has passed one to us we use that, otherwise we bind our own
+def open_listening_socket(port, backlog):
+    if ((os.environ.get('LISTEN_PID') == str(os.getpid())) and (int(os.environ.get('LISTEN_FDS', '0')) >= 1)):
+        return socket.socket(fileno=LISTEN_FDS_START)
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if (hasattr(socket, 'SO_REUSEPORT')):
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    client_socket.bind(('', port))
+    client_socket.listen(backlog)
+    return client_socket
+
+def handle_client(args, client_socket):
+    # Make sure the config file passed is in the proper format
+    try:
+        config_file = args.config
+        config_file_type = config_file.rpartition('.')[2]
+
+        # Make sure config file is a .txt
+
+        if(config_file_type != 'txt'):
+            raise ValueError
+        else:
+            # Parse config file, and store the server details in a dictionary
+            server_dict = parse_config_file(config_file)
+    except ValueError:
+        print('[ERROR]  Invalid config file. Config file must be a txt and must only contain lines of the format host:port. Only one host:port combination per line. Remove any random trailing whitespace')
+        sys.exit(1)
+
+    # Get performance of all servers. If we saved it last time, we route with that straight away and test the servers again in the background
+    # Servers missing from the saved table join in once they have been tested. If none of the saved servers are active, we test them all now
+    saved = load_state()
+    known = {server: saved[server] for server in server_dict if server in saved}
+    if (len(known) > 0) and update_routing(known):
+        print('\n[WARM START] Using saved latencies from ' + STATE_FILE + ', testing servers again in the background')
+        threading.Thread(target=refresh_routing, args=(list(server_dict),), daemon=True).start()
+    else:
+        server_dict = test_connection(server_dict)
+        save_state(server_dict)
+        if (not update_routing(server_dict)):
+            print("[ERROR] No servers are active. Please check that servers are corrctly entered in config file. Exiting program.")
+            sys.exit(1)
+
+    # Now that we have prioritized the servers, we can accept requests
+    print('\n[ACTIVATED] Clients can create connections at port ' + str(client_socket.getsockname()[1]))
+    client_socket.settimeout(TIMEOUT)
+
+    # Watch each connection until its request arrives, then queue it for a worker
+    while(1):
+        conn, addr = client_socket.accept()
+        client_socket.settimeout(TIMEOUT)
+        conn.settimeout(KEEP_ALIVE_TIMEOUT)
+        watch_connection(conn, addr)
 
 # Main function
 def main():
 
-    # Register signal alarm for program
+    # Make sure the user is passing a config file, and check for listening, admission control, edge cache, debugging and draining options
+    global connection_queue, rate_limit, rate_burst, edge_cache_enabled, edge_cache_object_size, edge_cache_max_bytes, edge_cache_ttl, drain_timeout, listening_socket, debug_report_dir
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', help='config file listing the servers, one host:port per line')
+    parser.add_argument('--port', type=int, default=0, help='port to listen on (0 picks a free port at random)')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help='how many connections may wait to be accepted')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help='how many connections are served at once')
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE, help='how many accepted connections may wait to be served before new ones get a 503')
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT, help='requests a second allowed from each client address (0, the default, for no limit)')
+    parser.add_argument('--rate-burst', type=int, default=RATE_BURST, help='how many requests a client may make in a burst')
+    parser.add_argument('--edge-cache', action='store_true', help='serve small files from memory instead of redirecting to a server')
+    parser.add_argument('--cache-object-size', type=int, default=EDGE_CACHE_OBJECT_SIZE, help='largest file the edge cache will hold, in bytes')
+    parser.add_argument('--cache-size', type=int, default=EDGE_CACHE_MAX_BYTES, help='total size of the edge cache, in bytes')
+    parser.add_argument('--cache-ttl', type=float, default=EDGE_CACHE_TTL, help='seconds before a cached file is revalidated with its server')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT, help='seconds to wait for requests to finish after SIGTERM')
+    parser.add_argument('--debug-dir', default=debug_report_dir, help='directory to write reports to on SIGUSR1 and SIGUSR2')
+    args = parser.parse_args()
+    drain_timeout = args.drain_timeout
+    debug_report_dir = args.debug_dir
+    edge_cache_enabled = args.edge_cache
+    edge_cache_object_size = args.cache_object_size
+    edge_cache_max_bytes = args.cache_size
+    edge_cache_ttl = args.cache_ttl
+    connection_queue = queue.Queue(max(args.max_queue, 1))
+    rate_limit = args.rate_limit
+    rate_burst = max(args.rate_burst, 1)
+
+    # Register signal alarm for program, SIGTERM for draining, and SIGUSR1 and SIGUSR2 for profiling
     signal(SIGINT, signal_handler)
+    signal(SIGTERM, drain_handler)
+    signal(SIGUSR1, profile_handler)
+    signal(SIGUSR2, snapshot_handler)
+
+    # The listening socket is opened once, so that clients can keep using the same port across idle reboots
+    listening_socket = open_listening_socket(args.port, args.backlog)
+
+    # Load our response pages and start writing the access log
+    load_pages()
+    threading.Thread(target=access_log_writer, daemon=True).start()
+    print('[LOGGING] Requests are logged to ' + ACCESS_LOG_FILE)
+
+    # Start the workers that serve client requests, and the thread watching connections between requests
+    for worker in range(max(args.max_connections, 1)):
+        threading.Thread(target=connection_worker, daemon=True).start()
+    threading.Thread(target=idle_watcher, daemon=True).start()
     
     # Run the load balancer, and reboot upon inactive use
     # Reboot set to 5 minutes / 300 seconds
     while(1):
         try:
-            handle_client()
+            handle_client(args, listening_socket)
         except socket.timeout:
             print("[TIMEOUT ERROR] Server was idle too long. Re-booting now.")
 
@@ -1,71 +1,1148 @@
 import socket
 import os
+import argparse
 import datetime
+import email.utils
 import signal
 import sys
+import threading
+import time
+import json
+import re
+import queue
+import random
+import posixpath
+import urllib.parse
+import math
+import struct
+import ctypes
+import ctypes.util
+import collections
+import tracemalloc
+import hashlib
+import mmap
+import selectors
+import tempfile
+import fcntl
+from stat import S_ISREG
+
+# The port we listen on
 
-# Constant for our buffer size
- 
-BUFFER_SIZE = 1024
 PORT = 5050
 
+# How long a persistent connection may sit idle before we close it
+
+KEEP_ALIVE_TIMEOUT = 15
+
+# Socket tuning, which can be changed on the command line.  TCP_NODELAY stops
+# Nagle's algorithm holding back the last small segment of a response,
+# SEND_BUFFER_SIZE sets SO_SNDBUF on client connections (0 leaves the system
+# default) and LISTEN_BACKLOG is how many connections may wait to be accepted.
+
+TCP_NODELAY = True
+SEND_BUFFER_SIZE = 0
+LISTEN_BACKLOG = 128
+tcp_nodelay = TCP_NODELAY
+send_buffer_size = SEND_BUFFER_SIZE
+
+# Everything we know about the files we serve is kept in an index, built when
+# we start and kept up to date by watching CONTENT_ROOT with inotify (or by
+# rescanning it every INDEX_POLL_INTERVAL seconds where inotify is not
+# available), so requests never need to look at the filesystem before sending.
+
+CONTENT_ROOT = '.'
+INDEX_POLL_INTERVAL = 2
+file_index = {}
+index_ready = threading.Event()
+
+# Files we write ourselves, such as the access log, are left out of the index
+# and never served, as they hold other clients' addresses and requests.  Paths
+# in private_files are left out exactly, and any path starting with one of
+# private_prefixes is left out too (for rotated logs, say).
+
+private_files = set()
+private_prefixes = []
+
+# inotify event flags, from <sys/inotify.h>.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Shared content store.  With --store, files are served from a store that
+# every server on the host can share, instead of from our own directory.  The
+# store's manifest, STORE_MANIFEST, maps each path to the SHA-256 of its
+# contents, and each body is kept once, read-only, under STORE_OBJECTS and
+# named by its hash, so the servers share one copy on disk and in the page
+# cache.  The hash is also the file's ETag, so every server gives a file the
+# same one.  Small files are sent from read-only mmaps of their objects, kept
+# in store_maps.  The manifest is reloaded when it changes, which we check
+# every INDEX_POLL_INTERVAL seconds.  --import-store adds the files in our
+# own directory to the store before we start, other than this program, our
+# error pages, compiled Python files, the files we write ourselves and the
+# store itself, so that one server's log is not handed out by all of them.
+
+STORE_MANIFEST = 'manifest.json'
+STORE_OBJECTS = 'objects'
+HASH_CHUNK_SIZE = 1024 * 1024
+store_directory = None
+store_maps = {}
+store_maps_lock = threading.Lock()
+
+# Admission control.  Requests are served by a pool of MAX_CONNECTIONS worker
+# threads, and up to MAX_QUEUE more may wait for a free worker.  Beyond that,
+# new requests are turned away at once with a 503 and a Retry-After of
+# RETRY_AFTER seconds rather than being left to time out.  Connections waiting
+# for a request do not hold a worker: they are watched by a single thread with
+# idle_selector, and only queued for a worker once a request arrives, so that
+# clients keeping connections open cannot hold up anyone else.  Each client
+# address can also be given a token bucket allowing --rate-limit requests a
+# second, in bursts of up to RATE_BURST.  This is off by default (a RATE_LIMIT
+# of 0), as clients sharing an address, such as the load balancer fetching for
+# its edge cache, would throttle each other.  Buckets are pruned once there are
+# more than RATE_BUCKETS_MAX of them.
+
+MAX_CONNECTIONS = 64
+MAX_QUEUE = 128
+RETRY_AFTER = 1
+RATE_LIMIT = 0
+RATE_BURST = 100
+RATE_BUCKETS_MAX = 10000
+connection_queue = None
+rate_limit = RATE_LIMIT
+rate_burst = RATE_BURST
+rate_buckets = {}
+rate_lock = threading.Lock()
+idle_selector = selectors.DefaultSelector()
+
+# Draining.  On SIGTERM we stop accepting connections, close the ones sitting
+# idle, and exit once the requests in progress are done or DRAIN_TIMEOUT
+# seconds have passed.  The listening socket may be handed to us by a service
+# manager (LISTEN_FDS, starting at descriptor LISTEN_FDS_START, as systemd
+# does), and is otherwise bound with SO_REUSEPORT so that a new server can
+# start on the same port while the old one drains.
+
+DRAIN_TIMEOUT = 30
+LISTEN_FDS_START = 3
+drain_timeout = DRAIN_TIMEOUT
+draining = threading.Event()
+listening_socket = None
+idle_lock = threading.Lock()
+
+# Files (or ranges) up to SMALL_FILE_SIZE bytes are read into memory and sent
+# along with the header in a single sendmsg, so they go out in as few packets
+# as possible.  Larger ones are sent with sendfile, with the socket corked
+# while the header and the start of the body are queued.
+
+SMALL_FILE_SIZE = 64 * 1024
+
+# Prewarming.  We count how often each file is sent, and save the counts to
+# ACCESS_COUNTS_FILE (or the file given with --access-counts), which is never
+# served, every ACCESS_COUNTS_INTERVAL seconds and when we shut down.  When we
+# start, before accepting connections, we ask the kernel to read the
+# PREWARM_FILES most requested files, up to PREWARM_BYTES in total, into the
+# page cache, so that our first requests are not served from a cold disk.
+# Files are read through instead where posix_fadvise is not available.
+
+ACCESS_COUNTS_FILE = 'access_counts.json'
+ACCESS_COUNTS_INTERVAL = 60
+PREWARM_FILES = 100
+PREWARM_BYTES = 256 * 1024 * 1024
+access_counts_file = ACCESS_COUNTS_FILE
+access_counts = {}
+access_counts_lock = threading.Lock()
+
+# Request metrics, served in Prometheus text format at METRICS_PATH.  Latencies
+# are counted into histogram buckets with the upper bounds (in seconds) below.
+
+METRICS_PATH = '/metrics'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+metrics_lock = threading.Lock()
+metrics = {
+    'requests': {},
+    'latency_buckets': [0] * len(LATENCY_BUCKETS),
+    'latency_sum': 0.0,
+    'latency_count': 0,
+    'bytes_sent': 0,
+    'in_flight': 0,
+    'log_dropped': 0,
+    'index_hits': 0,
+    'index_misses': 0,
+}
+
+# Access log.  Each request is written as a JSON line to ACCESS_LOG_FILE (or
+# the file given with --access-log) by a background thread, so handling a
+# request never waits on the disk or the terminal.  Records are handed over
+# through a queue holding up to ACCESS_LOG_QUEUE_SIZE of them; if it is full
+# the record is dropped (and counted in the metrics) rather than holding up the
+# request.  Only ACCESS_LOG_SAMPLE_RATE of successful requests are logged,
+# errors always are, and the file is rotated when it grows past
+# ACCESS_LOG_MAX_BYTES, keeping ACCESS_LOG_BACKUPS old files.  The log is never
+# served, even when it is written among the files we serve.
+
+ACCESS_LOG_FILE = 'access.log'
+ACCESS_LOG_QUEUE_SIZE = 10000
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 3
+access_log_file = ACCESS_LOG_FILE
+access_log_queue = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+
+# Profiling and tracing.  Clients on this machine can send GET requests for
+# DEBUG_PATH followed by a command: profile/start and profile/stop run a
+# sampling profiler, which looks at every thread's stack each PROFILE_INTERVAL
+# seconds; memory takes a tracemalloc snapshot (starting tracemalloc the first
+# time) and memory/stop stops it; timings dumps the last TIMINGS_SIZE requests
+# with how long each phase of handling them took.  SIGUSR1 starts and stops
+# the profiler and SIGUSR2 takes a memory snapshot and dumps the timings, with
+# the reports written to files named after DEBUG_REPORT_PREFIX in the system's
+# temporary directory (or the one given with --debug-dir), away from the files
+# we serve.  Reports are never served even if they are written among them.
+
+DEBUG_PATH = '/debug/'
+DEBUG_REPORT_PREFIX = 'debug-'
+debug_report_dir = tempfile.gettempdir()
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 25
+TIMINGS_SIZE = 1000
+profile_lock = threading.Lock()
+profile = None
+memory_snapshot = None
+timings = collections.deque(maxlen=TIMINGS_SIZE)
+request_phases = threading.local()
+
+# Request IDs.  The load balancer gives each request an ID, which it passes on
+# in the X-Request-ID header or as a request_id query parameter on the URL it
+# redirects to.  We send the ID back with our response and log it, so that the
+# two halves of a download can be matched up.  Requests without one are given
+# an ID of our own.  Only IDs matching REQUEST_ID_PATTERN are accepted, as they
+# are copied into our response headers.
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
 # Signal handler for graceful exiting.
 
 def signal_handler(sig, frame):
     print('\nInterrupt received, shutting down ...')
+    save_access_counts()
     sys.exit(0)
 
+# Signal handler for SIGTERM, to shut down without cutting off any transfers.
+# Connections already waiting to be accepted are taken and served, so that
+# closing the listening socket does not reset them.
+
+def drain_handler(sig, frame):
+    if (draining.is_set()):
+        return
+    print('Terminate received, draining connections ...')
+    draining.set()
+
+    # We may not be listening yet, if we are still starting up.
+
+    if (listening_socket is not None):
+        listening_socket.setblocking(False)
+        while (True):
+            try:
+                conn, addr = listening_socket.accept()
+            except OSError:
+                break
+            prepare_connection(conn)
+            queue_connection(conn, addr)
+        listening_socket.close()
+
+    # Close connections waiting for their next request, then wait for the rest.
+
+    with idle_lock:
+        for key in list(idle_selector.get_map().values()):
+            idle_selector.unregister(key.fileobj)
+            key.fileobj.close()
+    deadline = time.monotonic() + drain_timeout
+    while (((metrics['in_flight'] > 0) or (connection_queue.qsize() > 0)) and (time.monotonic() < deadline)):
+        time.sleep(0.1)
+    if (metrics['in_flight'] > 0):
+        print('Drain timed out with', metrics['in_flight'], 'connections still open')
+    save_access_counts()
+    sys.exit(0)
+
+# Status lines for every response we send, and the Connection headers, are
+# built once rather than for every response.
+
+STATUS_LINES = {
+    '200': 'HTTP/1.1 200 OK\r\n',
+    '206': 'HTTP/1.1 206 Partial Content\r\n',
+    '304': 'HTTP/1.1 304 Not Modified\r\n',
+    '404': 'HTTP/1.1 404 Not Found\r\n',
+    '416': 'HTTP/1.1 416 Range Not Satisfiable\r\n',
+    '501': 'HTTP/1.1 501 Method Not Implemented\r\n',
+    '503': 'HTTP/1.1 503 Service Unavailable\r\n',
+    '505': 'HTTP/1.1 505 Version Not Supported\r\n',
+}
+CONNECTION_HEADERS = {True: 'Connection: keep-alive\r\n', False: 'Connection: close\r\n'}
+
+# The pages sent with error responses are read into memory once, at startup.
+
+ERROR_PAGES = ('404.html', '416.html', '501.html', '503.html', '505.html')
+page_cache = {}
+
+# The Date header only changes once a second, so we keep the last one we built
+# along with the second it was built for.
+
+date_header_cache = (0, '')
+
+# Read the error pages into memory.
+
+def load_pages():
+    for page in ERROR_PAGES:
+        with open(page, 'rb') as page_file:
+            page_cache[page] = page_file.read()
+
+# Get the Date header for a response, rebuilding it only when the second
+# has changed since it was last built.
+
+def get_date_header():
+    global date_header_cache
+    now = int(time.time())
+    second, header = date_header_cache
+    if (second != now):
+        header = 'Date: ' + datetime.datetime.fromtimestamp(now).strftime('%a, %d %b %Y %H:%M:%S EDT') + '\r\n'
+        date_header_cache = (now, header)
+    return header
+
 # Create an HTTP response
 
 def prepare_response_message(value):
-    date = datetime.datetime.now()
-    date_string = 'Date: ' + date.strftime('%a, %d %b %Y %H:%M:%S EDT')
-    message = 'HTTP/1.1 '
-    if value == '200':
-        message = message + value + ' OK\r\n' + date_string + '\r\n'
-    elif value == '404':
-        message = message + value + ' Not Found\r\n' + date_string + '\r\n'
-    elif value == '501':
-        message = message + value + ' Method Not Implemented\r\n' + date_string + '\r\n'
-    elif value == '505':
-        message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
-    return message
-
-# Send the given response and file back to the client.
-
-def send_response_to_client(sock, code, file_name):
-
-    # Determine content type of file
-
-    if ((file_name.endswith('.jpg')) or (file_name.endswith('.jpeg'))):
-        type = 'image/jpeg'
-    elif (file_name.endswith('.gif')):
-        type = 'image/gif'
-    elif (file_name.endswith('.png')):
-        type = 'image/jpegpng'
-    elif ((file_name.endswith('.html')) or (file_name.endswith('.htm'))):
-        type = 'text/html'
+    return STATUS_LINES[value] + get_date_header()
+
+# Content types, by file extension.
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.png': 'image/png',
+    '.html': 'text/html',
+    '.htm': 'text/html',
+}
+
+# Determine content type of file
+
+def get_content_type(file_name):
+    return CONTENT_TYPES.get(os.path.splitext(file_name)[1].lower(), 'application/octet-stream')
+
+# Build the index entry for a file from its stat results.  The entry holds
+# everything needed to answer a request for the file without touching the
+# filesystem: its size, modification time, content type and validators.  The
+# ETag is made from the size and the modification time, so it changes whenever
+# the file is rewritten.
+
+def make_index_entry(path, stat):
+    return {
+        'path': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'type': get_content_type(path),
+        'etag': '"' + format(stat.st_size, 'x') + '-' + format(stat.st_mtime_ns, 'x') + '"',
+        'last_modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+    }
+
+# Turn a path on disk into the key it has in the index: relative to the
+# directory we serve, with / separators.
+
+def index_key(path):
+    return os.path.relpath(path, CONTENT_ROOT).replace(os.sep, '/')
+
+# Keep a file we write ourselves out of the index.  With prefix set, every
+# file whose path starts with the given one is kept out.
+
+def make_private(path, prefix=False):
+    path = os.path.abspath(path)
+    if (prefix):
+        private_prefixes.append(path)
     else:
-        type = 'application/octet-stream'
-    
-    # Get size of file
+        private_files.add(path)
 
-    file_size = os.path.getsize(file_name)
+# Check whether a path is one of the files we write ourselves.
 
-    # Construct header and send it
+def is_private(path):
+    path = os.path.abspath(path)
+    return ((path in private_files) or path.startswith(tuple(private_prefixes)))
 
-    header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+# Walk a directory and index every file under it.
+
+def scan_directory(directory):
+    entries = {}
+    for dir_path, dir_names, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if (is_private(path)):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (S_ISREG(stat.st_mode)):
+                key = index_key(path)
+                entries[key] = make_index_entry(key, stat)
+    return entries
+
+# Bring the index entry for one path up to date after it has changed on disk.
+
+def refresh_index_path(path):
+    if (is_private(path)):
+        return
+    key = index_key(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        file_index.pop(key, None)
+        return
+    if (S_ISREG(stat.st_mode)):
+        file_index[key] = make_index_entry(key, stat)
+    else:
+        file_index.pop(key, None)
 
-    # Open the file, read it, and send it
+# Drop every entry under a directory that has been removed or moved away.
 
-    with open(file_name, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
+def forget_index_directory(path):
+    prefix = index_key(path) + '/'
+    for key in [key for key in list(file_index) if key.startswith(prefix)]:
+        file_index.pop(key, None)
+
+# Watch the content directory with inotify, keeping the index current as files
+# are created, changed, moved and deleted.  Runs forever on its own thread.
+# inotify is reached through ctypes, as the standard library has no binding.
+
+def watch_with_inotify(libc, inotify_fd):
+    global file_index
+    watches = {}
+
+    def add_watches(directory):
+        for dir_path, dir_names, file_names in os.walk(directory):
+            watch = libc.inotify_add_watch(inotify_fd, os.fsencode(dir_path), INOTIFY_MASK)
+            if (watch >= 0):
+                watches[watch] = dir_path
+
+    add_watches(CONTENT_ROOT)
+    file_index = scan_directory(CONTENT_ROOT)
+    index_ready.set()
+    while (True):
+        events = os.read(inotify_fd, 64 * 1024)
+        offset = 0
+        while (offset < len(events)):
+            watch, mask, cookie, length = struct.unpack_from('iIII', events, offset)
+            name = events[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+
+            # We missed events, so start again from scratch.
+
+            if (mask & IN_Q_OVERFLOW):
+                file_index = scan_directory(CONTENT_ROOT)
+                continue
+            if (mask & IN_IGNORED):
+                watches.pop(watch, None)
+                continue
+            if ((watch not in watches) or (not name)):
+                continue
+            path = os.path.join(watches[watch], os.fsdecode(name))
+            if (mask & IN_ISDIR):
+                if (mask & (IN_CREATE | IN_MOVED_TO)):
+                    add_watches(path)
+                    file_index.update(scan_directory(path))
+                else:
+                    forget_index_directory(path)
             else:
+                refresh_index_path(path)
+
+# Where inotify is not available, rescan the content directory every
+# INDEX_POLL_INTERVAL seconds instead.
+
+def watch_with_polling():
+    global file_index
+    while (True):
+        file_index = scan_directory(CONTENT_ROOT)
+        index_ready.set()
+        time.sleep(INDEX_POLL_INTERVAL)
+
+# Work out where the object with the given hash is kept in the store.
+
+def object_path(digest):
+    return os.path.join(store_directory, STORE_OBJECTS, digest[:2], digest[2:])
+
+# Read the store's manifest.  Returns an empty manifest if there is none yet.
+
+def load_manifest():
+    try:
+        with open(os.path.join(store_directory, STORE_MANIFEST), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+# Copy a file into the store, hashing it as we go, and return its hash.  The
+# copy is only renamed into place once it is complete, and if the store
+# already has the same contents the copy is thrown away.
+
+def add_to_store(source):
+    digest = hashlib.sha256()
+    objects = os.path.join(store_directory, STORE_OBJECTS)
+    os.makedirs(objects, exist_ok=True)
+    temp = os.path.join(objects, 'import-' + str(os.getpid()) + '.tmp')
+    with open(source, 'rb') as source_file, open(temp, 'wb') as temp_file:
+        for chunk in iter(lambda: source_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            temp_file.write(chunk)
+    digest = digest.hexdigest()
+    target = object_path(digest)
+    if (os.path.exists(target)):
+        os.remove(temp)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(temp, 0o444)
+        os.replace(temp, target)
+    return digest
+
+# Check whether a file in our own directory should be left out of the store.
+
+def skip_import(key):
+    path = os.path.abspath(os.path.join(CONTENT_ROOT, key))
+    return ((path == os.path.abspath(__file__)) or (key in ERROR_PAGES) or ('__pycache__' in key.split('/')) or
+            (path + os.sep).startswith(store_directory + os.sep))
+
+# Add the files in our own directory to the store and its manifest.  The
+# manifest is merged with any changes other servers have made while we hold a
+# lock on the store, so servers importing at the same time do not lose each
+# other's files.  Returns how many files were added.
+
+def import_into_store():
+    files = {}
+    for key, entry in scan_directory(CONTENT_ROOT).items():
+        if (skip_import(key)):
+            continue
+        try:
+            files[key] = {'sha256': add_to_store(os.path.join(CONTENT_ROOT, entry['path'])), 'mtime': entry['mtime']}
+        except OSError as error:
+            print('Could not add ' + key + ' to the store:', error)
+    os.makedirs(store_directory, exist_ok=True)
+    lock = os.open(store_directory, os.O_RDONLY)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest()
+        manifest.update(files)
+        temp = os.path.join(store_directory, STORE_MANIFEST + '.' + str(os.getpid()) + '.tmp')
+        with open(temp, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp, os.path.join(store_directory, STORE_MANIFEST))
+    finally:
+        os.close(lock)
+    return len(files)
+
+# Build index entries for the files in the store's manifest, leaving out any
+# whose objects are missing.
+
+def scan_store():
+    entries = {}
+    for key, record in load_manifest().items():
+        try:
+            digest = record['sha256']
+            stat = os.stat(object_path(digest))
+        except (OSError, KeyError, TypeError):
+            continue
+        mtime = record.get('mtime', stat.st_mtime)
+        entries[key] = {
+            'path': object_path(digest),
+            'size': stat.st_size,
+            'mtime': mtime,
+            'type': get_content_type(key),
+            'etag': '"' + digest + '"',
+            'last_modified': email.utils.formatdate(mtime, usegmt=True),
+            'sha256': digest,
+        }
+    return entries
+
+# Keep the file index up to date with the store's manifest, reloading it
+# whenever it changes.  Maps of objects no longer in the manifest are dropped.
+# This runs forever on its own thread.
+
+def watch_store():
+    global file_index, store_maps
+    manifest = os.path.join(store_directory, STORE_MANIFEST)
+    loaded = None
+    while (True):
+        try:
+            changed = os.stat(manifest).st_mtime_ns
+        except OSError:
+            changed = None
+        if (changed != loaded):
+            loaded = changed
+            file_index = scan_store()
+            digests = set(entry['sha256'] for entry in file_index.values())
+            with store_maps_lock:
+                store_maps = {digest: body for digest, body in store_maps.items() if (digest in digests)}
+        index_ready.set()
+        time.sleep(INDEX_POLL_INTERVAL)
+
+# Get a read-only map of a small file's object in the store, mapping it the
+# first time it is asked for.  Every server mapping the same object shares the
+# same pages of memory.
+
+def store_map(entry):
+    with store_maps_lock:
+        body = store_maps.get(entry['sha256'])
+        if (body is None):
+            body = b''
+            if (entry['size'] > 0):
+                with open(entry['path'], 'rb') as object_file:
+                    body = mmap.mmap(object_file.fileno(), 0, access=mmap.ACCESS_READ)
+            store_maps[entry['sha256']] = body
+    return body
+
+# Build the file index and start keeping it up to date: from the store's
+# manifest if we are serving from a store, otherwise from our own directory
+# with inotify if we can and by polling if not.  Returns once the first scan
+# is complete.
+
+def start_file_index():
+    libc = None
+    inotify_fd = -1
+    if (store_directory is None):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            pass
+    if (store_directory is not None):
+        threading.Thread(target=watch_store, daemon=True).start()
+        watcher = 'the store manifest in ' + store_directory + ', checked every ' + str(INDEX_POLL_INTERVAL) + ' seconds'
+    elif (inotify_fd >= 0):
+        threading.Thread(target=watch_with_inotify, args=(libc, inotify_fd), daemon=True).start()
+        watcher = 'inotify'
+    else:
+        threading.Thread(target=watch_with_polling, daemon=True).start()
+        watcher = 'polling every ' + str(INDEX_POLL_INTERVAL) + ' seconds'
+    index_ready.wait()
+    print('Indexed ' + str(len(file_index)) + ' files, watching for changes with ' + watcher)
+
+# Count a lookup in the file index in the metrics.
+
+def record_index_lookup(hit):
+    with metrics_lock:
+        metrics['index_hits' if hit else 'index_misses'] += 1
+
+# Count a file being sent, for prewarming.
+
+def count_access(path):
+    with access_counts_lock:
+        access_counts[path] = access_counts.get(path, 0) + 1
+
+# Load the access counts saved last time we ran, if there are any.
+
+def load_access_counts():
+    try:
+        with open(access_counts_file, 'r') as counts_file:
+            counts = json.load(counts_file)
+        with access_counts_lock:
+            access_counts.update({str(path): int(count) for path, count in counts.items()})
+    except (OSError, ValueError, AttributeError, TypeError):
+        pass
+
+# Save the access counts.  They are written to a temporary file first, so a
+# crash part way through never leaves a broken counts file.
+
+def save_access_counts():
+    with access_counts_lock:
+        counts = dict(access_counts)
+    try:
+        with open(access_counts_file + '.tmp', 'w') as counts_file:
+            json.dump(counts, counts_file)
+        os.replace(access_counts_file + '.tmp', access_counts_file)
+    except OSError as error:
+        print('Could not save access counts:', error)
+
+# Save the access counts every ACCESS_COUNTS_INTERVAL seconds, if they have
+# changed.  This runs forever on its own thread.
+
+def access_counts_writer():
+    saved = None
+    while (True):
+        time.sleep(ACCESS_COUNTS_INTERVAL)
+        with access_counts_lock:
+            changed = (access_counts != saved)
+            saved = dict(access_counts)
+        if (changed):
+            save_access_counts()
+
+# Bring the most requested files into the page cache, most requested first,
+# skipping any that would take us past max_bytes.  Returns how many files and
+# bytes were prewarmed.
+
+def prewarm_files(max_files, max_bytes):
+    with access_counts_lock:
+        popular = sorted(access_counts, key=access_counts.get, reverse=True)
+    files = 0
+    total = 0
+    for path in popular:
+        entry = file_index.get(path)
+        if ((files >= max_files) or (entry is None) or (total + entry['size'] > max_bytes)):
+            continue
+        try:
+            fd = os.open(os.path.join(CONTENT_ROOT, entry['path']), os.O_RDONLY)
+            try:
+                if (hasattr(os, 'posix_fadvise')):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while (os.read(fd, 1024 * 1024)):
+                        pass
+            finally:
+                os.close(fd)
+        except OSError:
+            continue
+        files += 1
+        total += entry['size']
+    return files, total
+
+# Check an If-None-Match header against a file's ETag.  The header may list
+# several ETags, or be * to match any copy of the file.
+
+def if_none_match(header, etag):
+
+    if (header is None):
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return (('*' in tags) or (etag in tags))
+
+# Work out which bytes of a file the client asked for.  Only a single range of
+# the form bytes=start-end, bytes=start- or bytes=-suffix is supported.  Returns
+# None when the whole file should be sent, which includes ranges that are not
+# valid (such as one ending before it starts), and raises ValueError when the
+# range starts beyond the end of the file.
+
+def parse_range_header(range_header, file_size):
+    unit, _, byte_range = range_header.partition('=')
+    if ((unit.strip() != 'bytes') or (',' in byte_range)):
+        return None
+    first, _, last = byte_range.strip().partition('-')
+    try:
+        if (first == ''):
+            suffix = int(last)
+            if (suffix <= 0):
+                raise ValueError
+            start = max(file_size - suffix, 0)
+            end = file_size - 1
+        else:
+            start = int(first)
+            end = int(last) if (last != '') else file_size - 1
+            if ((last != '') and (end < start)):
+                return None
+            end = min(end, file_size - 1)
+    except ValueError:
+        return None
+    if ((start > end) or (start >= file_size)):
+        raise ValueError
+    return (start, end)
+
+# Send the given response and file back to the client.  Files are described by
+# their entry in the file index, pages by their name.  If byte_range is given
+# only that part of the file is sent, as the body of a 206 response.  The
+# Connection header tells the client whether we will keep the connection open.
+# Returns the number of bytes sent.
+
+def send_response_to_client(sock, code, file_name, byte_range=None, content_range=None, keep_alive=True, entry=None, retry_after=None, request_id=None):
+
+    # Get the content type and size of the file and the part of it we are
+    # sending.  Error pages are already in memory, and everything else we
+    # know about files is in the index.
+
+    body = page_cache.get(file_name)
+    if (body is not None):
+        type = 'text/html'
+        file_size = len(body)
+    else:
+        type = entry['type']
+        file_size = entry['size']
+    if (byte_range is None):
+        start, end = 0, file_size - 1
+    else:
+        start, end = byte_range
+        content_range = 'bytes ' + str(start) + '-' + str(end) + '/' + str(file_size)
+
+    # Construct header and send it.  Files we serve carry validators so that
+    # clients can resume interrupted downloads with a range request, and
+    # caches can check their copy is current.  A 304 has no body, so it is
+    # sent as soon as the header is ready.
+
+    parts = [prepare_response_message(code), 'Content-Type: ', type, '\r\n']
+    if (code != '304'):
+        parts += ['Content-Length: ', str(end - start + 1), '\r\n']
+    if ((code == '200') or (code == '206') or (code == '304')):
+        parts += ['Accept-Ranges: bytes\r\nETag: ', entry['etag'], '\r\nLast-Modified: ', entry['last_modified'], '\r\n']
+    if (content_range is not None):
+        parts += ['Content-Range: ', content_range, '\r\n']
+    if (retry_after is not None):
+        parts += ['Retry-After: ', str(retry_after), '\r\n']
+    if (request_id is not None):
+        parts += ['X-Request-ID: ', request_id, '\r\n']
+    parts += [CONNECTION_HEADERS[keep_alive], '\r\n']
+    header = ''.join(parts).encode()
+    mark_phase('header')
+    if (code == '304'):
+        sock.sendall(header)
+        return len(header)
+
+    # Pages we have in memory, and small files, go out along with the header
+    # in a single sendmsg.
+
+    bytes_to_send = end - start + 1
+    if (body is not None):
+        return send_buffers(sock, [header, body])
+    if (('sha256' in entry) and (entry['size'] <= SMALL_FILE_SIZE)):
+        return send_buffers(sock, [header, memoryview(store_map(entry))[start:end + 1]])
+    with open(os.path.join(CONTENT_ROOT, entry['path']), 'rb') as file_to_send:
+        mark_phase('open')
+        if (bytes_to_send <= SMALL_FILE_SIZE):
+            return send_buffers(sock, [header, os.pread(file_to_send.fileno(), bytes_to_send, start)])
+
+        # Larger files are sent with sendfile.  Corking the socket holds the
+        # header back until it can share a full segment with the body.
+
+        cork(sock, True)
+        try:
+            sock.sendall(header)
+            bytes_sent = len(header) + sock.sendfile(file_to_send, start, bytes_to_send)
+        finally:
+            cork(sock, False)
+    return bytes_sent
+
+# Send several buffers with one sendmsg (scatter/gather), so the kernel can
+# put them in the same packets, carrying on with whatever did not fit in the
+# socket's buffer.  Returns the number of bytes sent.
+
+def send_buffers(sock, buffers):
+
+    views = [memoryview(buffer) for buffer in buffers if (len(buffer) > 0)]
+    total = sum(len(view) for view in views)
+    while (views):
+        sent = sock.sendmsg(views)
+        while (views and (sent >= len(views[0]))):
+            sent -= len(views[0])
+            views.pop(0)
+        if (views):
+            views[0] = views[0][sent:]
+    return total
+
+# Turn TCP_CORK on or off for a socket, where the platform has it.
+
+def cork(sock, corked):
+
+    if (hasattr(socket, 'TCP_CORK')):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if corked else 0)
+
+# Send a response whose body is some text we have generated, rather than a
+# file.  Returns the number of bytes sent.
+
+def send_text_to_client(sock, code, text, type, keep_alive=True, request_id=None):
+
+    body = text.encode()
+    parts = [prepare_response_message(code), 'Content-Type: ', type, '\r\nContent-Length: ', str(len(body)), '\r\n']
+    if (request_id is not None):
+        parts += ['X-Request-ID: ', request_id, '\r\n']
+    header = ''.join(parts + [CONNECTION_HEADERS[keep_alive], '\r\n'])
+    message = header.encode() + body
+    sock.sendall(message)
+    return len(message)
+
+# Record a request we have finished with in the metrics.
+
+def record_request(code, duration, bytes_sent):
+
+    with metrics_lock:
+        metrics['requests'][code] = metrics['requests'].get(code, 0) + 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if (duration <= bound):
+                metrics['latency_buckets'][index] += 1
                 break
+        metrics['latency_sum'] += duration
+        metrics['latency_count'] += 1
+        metrics['bytes_sent'] += bytes_sent
+
+# Render the metrics in the Prometheus text exposition format.
+
+def render_metrics():
+
+    with metrics_lock:
+        lines = ['# HELP server_requests_total Requests served, by response status.', '# TYPE server_requests_total counter']
+        for code, count in sorted(metrics['requests'].items()):
+            lines.append('server_requests_total{code="' + code + '"} ' + str(count))
+        lines.append('# HELP server_request_duration_seconds Time taken to serve a request.')
+        lines.append('# TYPE server_request_duration_seconds histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, metrics['latency_buckets']):
+            cumulative += count
+            lines.append('server_request_duration_seconds_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append('server_request_duration_seconds_bucket{le="+Inf"} ' + str(metrics['latency_count']))
+        lines.append('server_request_duration_seconds_sum ' + str(metrics['latency_sum']))
+        lines.append('server_request_duration_seconds_count ' + str(metrics['latency_count']))
+        lines.append('# HELP server_bytes_sent_total Bytes sent to clients, headers included.')
+        lines.append('# TYPE server_bytes_sent_total counter')
+        lines.append('server_bytes_sent_total ' + str(metrics['bytes_sent']))
+        lines.append('# HELP server_connections_in_flight Client connections with a request being served.')
+        lines.append('# TYPE server_connections_in_flight gauge')
+        lines.append('server_connections_in_flight ' + str(metrics['in_flight']))
+        lines.append('# HELP server_connections_idle Client connections open and waiting for a request.')
+        lines.append('# TYPE server_connections_idle gauge')
+        lines.append('server_connections_idle ' + str(len(idle_selector.get_map())))
+        lines.append('# HELP server_connections_queued Client connections waiting for a free worker.')
+        lines.append('# TYPE server_connections_queued gauge')
+        lines.append('server_connections_queued ' + str(connection_queue.qsize() if connection_queue else 0))
+        lines.append('# HELP server_access_log_dropped_total Access log records dropped because the log queue was full.')
+        lines.append('# TYPE server_access_log_dropped_total counter')
+        lines.append('server_access_log_dropped_total ' + str(metrics['log_dropped']))
+        lines.append('# HELP server_index_lookups_total Requested files looked up in the file index, by whether they were found.')
+        lines.append('# TYPE server_index_lookups_total counter')
+        lines.append('server_index_lookups_total{result="hit"} ' + str(metrics['index_hits']))
+        lines.append('server_index_lookups_total{result="miss"} ' + str(metrics['index_misses']))
+    return '\n'.join(lines) + '\n'
+
+# Queue a record for the access log, without ever waiting for room.
+
+def log_access(record):
+
+    if ((record['status'] < '400') and (random.random() >= ACCESS_LOG_SAMPLE_RATE)):
+        return
+    entry = {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds')}
+    entry.update(record)
+    try:
+        access_log_queue.put_nowait(entry)
+    except queue.Full:
+        with metrics_lock:
+            metrics['log_dropped'] += 1
+
+# Rotate the access log: access.log becomes access.log.1, access.log.1 becomes
+# access.log.2 and so on, dropping the oldest.
+
+def rotate_access_log():
+
+    for index in range(ACCESS_LOG_BACKUPS - 1, 0, -1):
+        if (os.path.exists(access_log_file + '.' + str(index))):
+            os.replace(access_log_file + '.' + str(index), access_log_file + '.' + str(index + 1))
+    if (ACCESS_LOG_BACKUPS > 0):
+        os.replace(access_log_file, access_log_file + '.1')
+    else:
+        os.remove(access_log_file)
+
+# Write queued access log records out.  This runs forever on its own thread,
+# writing whatever has built up in the queue in one go each time round.
+
+def access_log_writer():
+
+    log_file = open(access_log_file, 'a')
+    while (True):
+        lines = [json.dumps(access_log_queue.get())]
+        while (True):
+            try:
+                lines.append(json.dumps(access_log_queue.get_nowait()))
+            except queue.Empty:
+                break
+        try:
+            log_file.write('\n'.join(lines) + '\n')
+            log_file.flush()
+            if (log_file.tell() >= ACCESS_LOG_MAX_BYTES):
+                log_file.close()
+                rotate_access_log()
+                log_file = open(access_log_file, 'a')
+        except OSError as error:
+            print('Could not write to the access log:', error)
+
+# Start timing the phases of a request on this thread.
+
+def start_phases():
+
+    request_phases.marks = []
+    request_phases.last = time.perf_counter()
+
+# Note that a phase of the current request has finished.  Requests that are
+# not being timed, such as ones turned away before they are read, are ignored.
+
+def mark_phase(name):
+
+    marks = getattr(request_phases, 'marks', None)
+    if (marks is not None):
+        now = time.perf_counter()
+        marks.append((name, round((now - request_phases.last) * 1000, 3)))
+        request_phases.last = now
+
+# Add the phases of the current request to the timings, along with the
+# request details in record.
+
+def record_phases(record):
+
+    record['phases_ms'] = dict(request_phases.marks)
+    request_phases.marks = None
+    timings.append(record)
+
+# Look at the stack of every thread but our own, counting the line each one is
+# on and every function on its stack.  Threads waiting inside the threading
+# module, such as workers with no connection to serve, are left out.  Runs on
+# its own thread until stopped.
+
+def profile_sampler(state):
+
+    me = threading.get_ident()
+    while (not state['stop'].wait(PROFILE_INTERVAL)):
+        frames = sys._current_frames()
+        with profile_lock:
+            for ident, frame in frames.items():
+                code = frame.f_code
+                if ((ident == me) or (code.co_filename == threading.__file__)):
+                    continue
+                key = code.co_filename + ':' + str(frame.f_lineno) + ' ' + code.co_name
+                state['self'][key] = state['self'].get(key, 0) + 1
+                seen = set()
+                while (frame is not None):
+                    code = frame.f_code
+                    key = code.co_filename + ':' + str(code.co_firstlineno) + ' ' + code.co_name
+                    if (key not in seen):
+                        seen.add(key)
+                        state['total'][key] = state['total'].get(key, 0) + 1
+                    frame = frame.f_back
+            state['samples'] += 1
+
+# Start the sampling profiler, unless it is already running.
+
+def start_profiler():
+
+    global profile
+    with profile_lock:
+        if (profile is not None):
+            return 'The profiler is already running\n'
+        profile = {'stop': threading.Event(), 'started': time.monotonic(), 'samples': 0, 'self': {}, 'total': {}}
+        threading.Thread(target=profile_sampler, args=(profile,), daemon=True).start()
+    return 'Profiler started, sampling every ' + str(PROFILE_INTERVAL) + ' seconds\n'
+
+# Stop the sampling profiler and report the lines threads were most often on,
+# and the functions most often on their stacks.  Threads waiting for the
+# network show up in recv, accept and the like.
+
+def stop_profiler():
+
+    global profile
+    with profile_lock:
+        state = profile
+        profile = None
+    if (state is None):
+        return 'The profiler is not running\n'
+    state['stop'].set()
+    lines = ['Sampled ' + str(state['samples']) + ' times over ' + str(round(time.monotonic() - state['started'], 3)) + ' seconds', '', 'Self (the line each thread was on):']
+    for key, count in sorted(state['self'].items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+        lines.append('%8d  %s' % (count, key))
+    lines += ['', 'Total (functions on each thread\'s stack):']
+    for key, count in sorted(state['total'].items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]:
+        lines.append('%8d  %s' % (count, key))
+    return '\n'.join(lines) + '\n'
+
+# Take a tracemalloc snapshot and report where memory is allocated, and what
+# has changed since the last snapshot.  The first call only starts tracing.
+
+def snapshot_memory():
+
+    global memory_snapshot
+    if (not tracemalloc.is_tracing()):
+        tracemalloc.start()
+        memory_snapshot = None
+        return 'tracemalloc started, ask again for a snapshot\n'
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['Traced memory: ' + str(current) + ' bytes, peak ' + str(peak) + ' bytes', '', 'Largest allocations:']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_TOP]]
+    if (memory_snapshot is not None):
+        lines += ['', 'Changes since the last snapshot:']
+        lines += [str(stat) for stat in snapshot.compare_to(memory_snapshot, 'lineno')[:PROFILE_TOP]]
+    memory_snapshot = snapshot
+    return '\n'.join(lines) + '\n'
+
+# Stop tracemalloc, freeing the memory it uses.
+
+def stop_memory_tracing():
+
+    global memory_snapshot
+    memory_snapshot = None
+    if (not tracemalloc.is_tracing()):
+        return 'tracemalloc is not running\n'
+    tracemalloc.stop()
+    return 'tracemalloc stopped\n'
+
+# Report the timings of recent requests, one JSON line each, oldest first.
+
+def dump_timings():
+
+    return ''.join(json.dumps(record) + '\n' for record in list(timings))
+
+# Run a debug command, returning the response code and the report.
+
+def run_debug_command(command):
+
+    commands = {
+        'profile/start': start_profiler,
+        'profile/stop': stop_profiler,
+        'memory': snapshot_memory,
+        'memory/stop': stop_memory_tracing,
+        'timings': dump_timings,
+    }
+    if (command not in commands):
+        return '404', 'Unknown debug command, try one of: ' + ', '.join(commands) + '\n'
+    return '200', commands[command]()
+
+# Write a debug report to a file and say where it went.
+
+def write_debug_report(name, report):
+
+    file_name = os.path.join(debug_report_dir, DEBUG_REPORT_PREFIX + name + '-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.txt')
+    try:
+        with open(file_name, 'w') as report_file:
+            report_file.write(report)
+        print('Wrote ' + file_name)
+    except OSError as error:
+        print('Could not write ' + file_name + ':', error)
+
+# Signal handler for SIGUSR1, starting the profiler or stopping it and writing
+# out its report.
+
+def profile_handler(sig, frame):
+
+    if (profile is None):
+        print(start_profiler(), end='')
+    else:
+        write_debug_report('profile', stop_profiler())
+
+# Signal handler for SIGUSR2, writing out a memory snapshot and the timings.
+
+def snapshot_handler(sig, frame):
+
+    write_debug_report('memory', snapshot_memory())
+    write_debug_report('timings', dump_timings())
+
+# Pick the request ID to use: the one in the X-Request-ID header, otherwise the
+# one from the URL, otherwise a new one.  IDs that do not look like ours are
+# ignored.
+
+def get_request_id(*candidates):
+
+    for candidate in candidates:
+        if ((candidate is not None) and REQUEST_ID_PATTERN.fullmatch(candidate)):
+            return candidate
+    return os.urandom(8).hex()
+
+# Check whether a client address is on this machine.
+
+def is_local(addr):
+
+    return (addr[0].startswith('127.') or (addr[0] == '::1'))
 
 # Read a single line (ending with \n) from a socket and return it.
 # We will strip out the \r and the \n in the process.
@@ -76,7 +1153,9 @@ def get_line_from_socket(sock):
     line = ''
     while (not done):
         char = sock.recv(1).decode()
-        if (char == '\r'):
+        if (char == ''):
+            raise ConnectionError('Connection closed by client')
+        elif (char == '\r'):
             pass
         elif (char == '\n'):
             done = True
@@ -84,82 +1163,404 @@ def get_line_from_socket(sock):
             line = line + char
     return line
 
-# Our main function.
+# Read the request headers into a dictionary keyed by lower-case header name.
 
-def main():
+def get_headers_from_socket(sock):
 
-    # Register our signal handler for shutting down.
+    headers = {}
+    while (True):
+        header_line = get_line_from_socket(sock)
+        if (header_line == ''):
+            break
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
 
-    signal.signal(signal.SIGINT, signal_handler)
+# Respond to a single request that has been read from a client connection.
+# Returns the status code sent and the number of bytes sent.
 
-    # Create the socket.  We will ask this to work on any interface and to pick
-    # a free port at random.  We'll print this out for clients to use.
+def handle_request(conn, request_list, headers, keep_alive, request_id=None):
 
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('', PORT))
-    print('Clients can create connections at port ' + str(server_socket.getsockname()[1]))
-    server_socket.listen(1)
-    
-    # Keep the server running forever.
-    
-    while(1):
-        print('Waiting for incoming client connection ...')
-        conn, addr = server_socket.accept()
-        print('Accepted connection from client address:', addr)
-        print('Connection to client established, waiting to receive message...')
+    # If we did not get a GET command respond with a 501.
+
+    if request_list[0] != 'GET':
+        return '501', send_response_to_client(conn, '501', '501.html', keep_alive=keep_alive, request_id=request_id)
+
+    # If we did not get the proper HTTP version respond with a 505.
+
+    elif request_list[2] != 'HTTP/1.1':
+        return '505', send_response_to_client(conn, '505', '505.html', keep_alive=keep_alive, request_id=request_id)
+
+    # Report our metrics if that is what was asked for.
+
+    elif request_list[1] == METRICS_PATH:
+        return '200', send_text_to_client(conn, '200', render_metrics(), 'text/plain; version=0.0.4', keep_alive, request_id)
+
+    # We have the right request and version, so check if file exists.
+              
+    else:
+
+        # If requested file begins with a / we strip it off, and tidy up any
+        # . or .. parts so that it matches its key in the index.
+
+        req_file = posixpath.normpath(request_list[1].lstrip('/'))
+
+        # Check if requested file exists and report a 404 if not.
+
+        entry = file_index.get(req_file)
+        record_index_lookup(entry is not None)
+        mark_phase('lookup')
+        if (entry is None):
+            return '404', send_response_to_client(conn, '404', '404.html', keep_alive=keep_alive, request_id=request_id)
+
+        # If the client already has the current copy of the file, according to
+        # If-None-Match, tell it so rather than sending the file again.
+
+        elif (if_none_match(headers.get('if-none-match'), entry['etag'])):
+            return '304', send_response_to_client(conn, '304', req_file, keep_alive=keep_alive, entry=entry, request_id=request_id)
+
+        # File exists, so prepare to send it!  If the client asked for part of
+        # the file, and its copy is still current according to If-Range, send
+        # only that part.
+
+        else:
+            byte_range = None
+            if ('range' in headers):
+                if_range = headers.get('if-range')
+                if ((if_range is None) or (if_range == entry['etag']) or (if_range == entry['last_modified'])):
+                    try:
+                        byte_range = parse_range_header(headers['range'], entry['size'])
+                    except ValueError:
+                        byte_range = False
+            if (byte_range is False):
+                return '416', send_response_to_client(conn, '416', '416.html', content_range='bytes */' + str(entry['size']), keep_alive=keep_alive, request_id=request_id)
+            count_access(req_file)
+            if (byte_range is not None):
+                return '206', send_response_to_client(conn, '206', req_file, byte_range, keep_alive=keep_alive, entry=entry, request_id=request_id)
+            else:
+                return '200', send_response_to_client(conn, '200', req_file, keep_alive=keep_alive, entry=entry, request_id=request_id)
+
+# Take a token from a client's bucket.  Returns 0 if the request may go ahead,
+# otherwise the number of seconds until the client will have a token again.
+
+def take_token(client):
+
+    if (rate_limit <= 0):
+        return 0
+    now = time.monotonic()
+    with rate_lock:
+        tokens, updated = rate_buckets.get(client, (rate_burst, now))
+        tokens = min(rate_burst, tokens + (now - updated) * rate_limit)
+        if (tokens >= 1):
+            rate_buckets[client] = (tokens - 1, now)
+            retry_after = 0
+        else:
+            rate_buckets[client] = (tokens, now)
+            retry_after = math.ceil((1 - tokens) / rate_limit)
+
+        # Forget clients whose buckets have filled back up, as they would
+        # start from a full bucket anyway.
+
+        if (len(rate_buckets) > RATE_BUCKETS_MAX):
+            full_after = rate_burst / rate_limit
+            for key in [key for key, (tokens, updated) in rate_buckets.items() if (now - updated >= full_after)]:
+                del rate_buckets[key]
+    return retry_after
+
+# Turn a connection away because we are too busy, with a 503 telling the client
+# when to try again.  This runs on the thread watching idle connections, so it
+# never waits long: the response is small enough to go straight into the
+# socket's send buffer.
+
+def reject_connection(conn, addr, retry_after):
+
+    bytes_sent = 0
+    try:
+        conn.settimeout(1)
+        bytes_sent = send_response_to_client(conn, '503', '503.html', keep_alive=False, retry_after=retry_after)
+
+        # Read whatever part of the request has arrived, so that closing the
+        # socket does not reset the connection before the client reads the 503.
+
+        conn.setblocking(False)
+        conn.recv(64 * 1024)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+    record_request('503', 0.0, bytes_sent)
+    log_access({
+        'request_id': None,
+        'client': addr[0] + ':' + str(addr[1]),
+        'method': '',
+        'path': '',
+        'status': '503',
+        'bytes': bytes_sent,
+        'duration_ms': 0.0,
+    })
+
+# Serve the next request on a client connection, which has been handed to us
+# because part of it has arrived.  Returns True if the connection should be
+# kept open for another request.
+
+def handle_connection(conn, addr):
+
+    with metrics_lock:
+        metrics['in_flight'] += 1
+    try:
 
         # We obtain our request from the socket.  We look at the request and
         # figure out what to do based on the contents of things.
 
-        request = get_line_from_socket(conn)
-        print('Received request:  ' + request)
-        request_list = request.split()
+        try:
+            request = get_line_from_socket(conn)
+            request_list = request.split()
 
-        # This server doesn't care about headers, so we just clean them up.
+            # The only headers we care about are the ones for range requests
+            # and keeping the connection open.  Timing starts once the request
+            # has begun to arrive.
 
-        while (get_line_from_socket(conn) != ''):
-            pass
+            start_phases()
+            headers = get_headers_from_socket(conn)
+            mark_phase('read')
+        except (ConnectionError, TimeoutError):
+            return False
+
+        # Take the request ID off the end of the path, where the load balancer
+        # may have put it.
 
-        # If we did not get a GET command respond with a 501.
+        request_id = None
+        if (len(request_list) > 1):
+            request_list[1], _, query = request_list[1].partition('?')
+            request_id = urllib.parse.parse_qs(query).get('request_id', [None])[0]
+        request_id = get_request_id(headers.get('x-request-id'), request_id)
 
-        if request_list[0] != 'GET':
-            print('Invalid type of request received ... responding with error!')
-            send_response_to_client(conn, '501', '501.html')
+        # Clients over their request rate are told when to come back.  Once we
+        # are draining, every response closes its connection.
 
-        # If we did not get the proper HTTP version respond with a 505.
+        started = time.monotonic()
+        keep_alive = ((headers.get('connection', '').lower() != 'close') and (not draining.is_set()))
+        retry_after = take_token(addr[0])
+        if (retry_after > 0):
+            keep_alive = False
+            code, bytes_sent = '503', send_response_to_client(conn, '503', '503.html', keep_alive=False, retry_after=retry_after, request_id=request_id)
 
-        elif request_list[2] != 'HTTP/1.1':
-            print('Invalid HTTP version received ... responding with error!')
-            send_response_to_client(conn, '505', '505.html')
+        # Debug commands are only taken from clients on this machine, and not
+        # from the load balancer fetching on behalf of someone else (which it
+        # says with a Via header).
 
-        # We have the right request and version, so check if file exists.
-                  
+        elif ((len(request_list) > 1) and request_list[1].startswith(DEBUG_PATH) and is_local(addr) and ('via' not in headers)):
+            code, report = run_debug_command(request_list[1][len(DEBUG_PATH):])
+            bytes_sent = send_text_to_client(conn, code, report, 'text/plain', keep_alive, request_id)
         else:
+            code, bytes_sent = handle_request(conn, request_list, headers, keep_alive, request_id)
+        mark_phase('send')
+        duration = time.monotonic() - started
+        record_phases({
+            'request_id': request_id,
+            'path': request_list[1] if (len(request_list) > 1) else '',
+            'status': code,
+            'bytes': bytes_sent,
+        })
+        record_request(code, duration, bytes_sent)
+        log_access({
+            'request_id': request_id,
+            'client': addr[0] + ':' + str(addr[1]),
+            'method': request_list[0] if (len(request_list) > 0) else '',
+            'path': request_list[1] if (len(request_list) > 1) else '',
+            'status': code,
+            'bytes': bytes_sent,
+            'duration_ms': round(duration * 1000, 3),
+        })
+        return keep_alive
+    finally:
+        with metrics_lock:
+            metrics['in_flight'] -= 1
 
-            # If requested file begins with a / we strip it off.
+# Serve requests from the queue, forever.  Each worker thread handles one
+# request at a time, and hands connections the client is keeping open back to
+# be watched until the next request arrives.
 
-            req_file = request_list[1]
-            while (req_file[0] == '/'):
-                req_file = req_file[1:]
+def connection_worker():
 
-            # Check if requested file exists and report a 404 if not.
+    while (True):
+        conn, addr = connection_queue.get()
+        keep_alive = False
+        try:
+            keep_alive = handle_connection(conn, addr)
+        except Exception as error:
+            print('Error serving client address', addr, ':', repr(error))
+        if (keep_alive):
+            watch_connection(conn, addr)
+        else:
+            conn.close()
 
-            if (not os.path.isfile(req_file)):
-                print('Requested file does not exist ... responding with error!')
-                send_response_to_client(conn, '404', '404.html')
+# Queue a connection for a worker, now that a request has arrived on it.  If
+# the queue is full we are overloaded, so the connection is turned away.
 
-            # File exists, so prepare to send it!  
+def queue_connection(conn, addr):
 
-            else:
-                print('Requested file good to go!  Sending file ...')
-                send_response_to_client(conn, '200', req_file)
-                
-        # We are all done with this client, so close the connection and
-        # Go back to get another one!
+    try:
+        connection_queue.put_nowait((conn, addr))
+    except queue.Full:
+        reject_connection(conn, addr, RETRY_AFTER)
+
+# Set up a newly accepted client connection.
+
+def prepare_connection(conn):
+
+    conn.settimeout(KEEP_ALIVE_TIMEOUT)
+    if (tcp_nodelay):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if (send_buffer_size > 0):
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+
+# Watch a connection until a request arrives on it.  Once we are draining,
+# connections are closed instead.
 
-        conn.close();
+def watch_connection(conn, addr):
+
+    with idle_lock:
+        if (not draining.is_set()):
+            idle_selector.register(conn, selectors.EVENT_READ, (addr, time.monotonic()))
+            return
+    conn.close()
+
+# Queue connections for a worker as requests arrive on them, and close those
+# left idle for longer than KEEP_ALIVE_TIMEOUT.  This runs forever on its own
+# thread.
+
+def idle_watcher():
+
+    while (True):
+        events = idle_selector.select(1)
+        now = time.monotonic()
+        ready = []
+        expired = []
+        with idle_lock:
+
+            # Connections may have been closed by draining since the select.
+
+            for key, mask in events:
+                if (idle_selector.get_map().get(key.fd) is key):
+                    idle_selector.unregister(key.fileobj)
+                    ready.append((key.fileobj, key.data[0]))
+            for key in list(idle_selector.get_map().values()):
+                if (now - key.data[1] >= KEEP_ALIVE_TIMEOUT):
+                    idle_selector.unregister(key.fileobj)
+                    expired.append(key.fileobj)
+        for conn, addr in ready:
+            queue_connection(conn, addr)
+        for conn in expired:
+            conn.close()
+
+# Get the socket to listen on.  If a service manager has passed one to us we
+# use that, otherwise we bind our own.
+
+def open_listening_socket(backlog):
+
+    if ((os.environ.get('LISTEN_PID') == str(os.getpid())) and (int(os.environ.get('LISTEN_FDS', '0')) >= 1)):
+        return socket.socket(fileno=LISTEN_FDS_START)
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if (hasattr(socket, 'SO_REUSEPORT')):
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(('', PORT))
+    server_socket.listen(backlog)
+    return server_socket
+
+# Our main function.
+
+def main():
+
+    # Check the command line for socket tuning, admission control, prewarming,
+    # content store, logging, debugging and draining options.
+
+    global tcp_nodelay, send_buffer_size, connection_queue, rate_limit, rate_burst, drain_timeout, listening_socket, store_directory, access_log_file, access_counts_file, debug_report_dir
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-nodelay', action='store_true', help='leave Nagle\'s algorithm on for client connections')
+    parser.add_argument('--send-buffer', type=int, default=SEND_BUFFER_SIZE, help='SO_SNDBUF size for client connections in bytes (0 for the system default)')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help='how many connections may wait to be accepted')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help='how many connections are served at once')
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE, help='how many accepted connections may wait to be served before new ones get a 503')
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT, help='requests a second allowed from each client address (0, the default, for no limit)')
+    parser.add_argument('--rate-burst', type=int, default=RATE_BURST, help='how many requests a client may make in a burst')
+    parser.add_argument('--prewarm-files', type=int, default=PREWARM_FILES, help='how many of the most requested files to bring into the page cache at start up')
+    parser.add_argument('--prewarm-bytes', type=int, default=PREWARM_BYTES, help='most bytes to bring into the page cache at start up (0 turns prewarming off)')
+    parser.add_argument('--access-counts', default=ACCESS_COUNTS_FILE, help='file to save how often each file is requested to, for prewarming')
+    parser.add_argument('--store', help='serve files from the shared content store in this directory rather than our own')
+    parser.add_argument('--import-store', action='store_true', help='add the files in our own directory to the --store before starting')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT, help='seconds to wait for transfers to finish after SIGTERM')
+    parser.add_argument('--access-log', default=ACCESS_LOG_FILE, help='file to write the access log to')
+    parser.add_argument('--debug-dir', default=debug_report_dir, help='directory to write reports to on SIGUSR1 and SIGUSR2')
+    args = parser.parse_args()
+    if (args.import_store and (args.store is None)):
+        parser.error('--import-store needs --store')
+    access_log_file = args.access_log
+    make_private(access_log_file)
+    make_private(access_log_file + '.', prefix=True)
+    access_counts_file = args.access_counts
+    make_private(access_counts_file)
+    make_private(access_counts_file + '.tmp')
+    debug_report_dir = args.debug_dir
+    make_private(os.path.join(debug_report_dir, DEBUG_REPORT_PREFIX), prefix=True)
+    drain_timeout = args.drain_timeout
+    tcp_nodelay = not args.no_nodelay
+    send_buffer_size = args.send_buffer
+    connection_queue = queue.Queue(max(args.max_queue, 1))
+    rate_limit = args.rate_limit
+    rate_burst = max(args.rate_burst, 1)
+
+    # Register our signal handlers for shutting down, at once or by draining,
+    # and for profiling.
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, drain_handler)
+    signal.signal(signal.SIGUSR1, profile_handler)
+    signal.signal(signal.SIGUSR2, snapshot_handler)
+
+    # Load our error pages, index the files we serve and start writing the
+    # access log.
+
+    load_pages()
+    if (args.store is not None):
+        store_directory = os.path.abspath(args.store)
+        if (args.import_store):
+            print('Added ' + str(import_into_store()) + ' files to the store in ' + store_directory)
+    start_file_index()
+    threading.Thread(target=access_log_writer, daemon=True).start()
+    print('Requests are logged to ' + access_log_file)
+
+    # Bring the files we were asked for most often last time into the page
+    # cache before we start listening, so that nothing (the load balancer's
+    # latency test included) is served while we are still warming up, and keep
+    # counting from there.
+
+    load_access_counts()
+    if ((args.prewarm_files > 0) and (args.prewarm_bytes > 0)):
+        files, total = prewarm_files(args.prewarm_files, args.prewarm_bytes)
+        print('Prewarmed ' + str(files) + ' files (' + str(total) + ' bytes) from ' + access_counts_file)
+    threading.Thread(target=access_counts_writer, daemon=True).start()
+
+    # Create the socket.  We will ask this to work on any interface and to pick
+    # a free port at random.  We'll print this out for clients to use.
+
+    server_socket = open_listening_socket(args.backlog)
+    listening_socket = server_socket
+    print('Clients can create connections at port ' + str(server_socket.getsockname()[1]))
+    
+    # Start the workers, then keep the server running forever, watching each
+    # connection until its request arrives and going back to get another one!
+
+    for worker in range(max(args.max_connections, 1)):
+        threading.Thread(target=connection_worker, daemon=True).start()
+    threading.Thread(target=idle_watcher, daemon=True).start()
+    
+    while(1):
+        conn, addr = server_socket.accept()
+        prepare_connection(conn)
+        watch_connection(conn, addr)
     
 
 if __name__ == '__main__':
     main()
-